@@ -8,6 +8,7 @@ University of California, Riverside
 Riverside, CA 92521, USA
 """
 
+import io
 import os
 import random
 import string
@@ -22,6 +23,7 @@ from cprofiler.profile import CompositionProfiler
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_SAMPLE_LENGTH'] = 64 * 1024 * 1024  # 64MB max decompressed sample size
 
 
 def get_header():
@@ -59,6 +61,7 @@ def get_body(query_sample,
              alpha_value,
              bonferroni,
              iterations,
+             method,
              aa_order,
              color_scheme,
              ylab,
@@ -144,6 +147,18 @@ def get_body(query_sample,
             </td>
             </tr>
             <tr>
+            <td align="right">
+                Method:
+            </td>
+            <td>
+                <select name="method">
+                <option value="sampling" {'selected="selected"' if method == 'sampling' else ''}>Permutation and bootstrap sampling</option>
+                <option value="analytic" {'selected="selected"' if method == 'analytic' else ''}>Analytic approximation</option>
+                </select>
+                <a href="help.html#method"><img src="{url_info_gif}" width="12" height="12" border="0"></a>
+            </td>
+            </tr>
+            <tr>
             <td align="right">
                 Significance (&alpha;) value:
             </td>
@@ -291,6 +306,16 @@ def print_error(message):
     """, header=get_header(), footer=get_footer(), message=message)
 
 
+def read_upload(file):
+    """Read a possibly compressed upload, or return None if it decompresses to
+    more than MAX_SAMPLE_LENGTH bytes"""
+
+    limit = app.config['MAX_SAMPLE_LENGTH']
+    data = Fasta.decompress_stream(io.BytesIO(file.read())).read(limit + 1)
+
+    return data if len(data) <= limit else None
+
+
 def highlight_rows(row):
     if row['test_result'] == 'Enriched':
         return ['background-color: lightgreen'] * len(row)
@@ -337,6 +362,7 @@ def profiler():
     alpha_value = float(request.form.get('alpha_value', 0.05))
     bonferroni = request.form.get('bonferroni') == 'on'
     iterations = int(request.form.get('iterations', 10000))
+    method = request.form.get('method', 'sampling')
 
     aa_order = request.form.get('aa_order', 'diff')
     color_scheme = request.form.get('color_scheme', 'mono')
@@ -349,7 +375,8 @@ def profiler():
     resolution = int(request.form.get('resolution', 300))
 
     if command == "create":
-        # Specify alphabet to produce data in the order in which it will be consumed
+        # Counts are produced in canonical order, and only permuted to the order
+        # in which they will be consumed
         if aa_order not in AminoAcid.list_orders():
             alphabet = AminoAcid.get_order('alpha')
         else:
@@ -359,33 +386,43 @@ def profiler():
         if query_sample:
             query = query_sample.upper().replace(' ', '').replace('\t', '')
         elif query_file and query_file.filename:
-            query = query_file.read().decode('utf-8').upper().replace(' ', '').replace('\t', '')
+            # Uploads may be compressed, e.g. .fa.gz
+            query = read_upload(query_file)
+            if query is None:
+                return print_error("Query sample too large.")
+            query = query.decode('utf-8').upper().replace(' ', '').replace('\t', '')
         else:
             return print_error("Query sample missing.")
 
-        sequences = Fasta.read_stream(query)
+        sequences = Fasta.read_stream(io.StringIO(query))
         if not sequences:
             return print_error("Query sample not in FastA format.")
 
-        query_counts = Fasta.count_chars(sequences, alphabet)
+        query_counts = Fasta.count_chars(sequences, AminoAcid.AA_1_LETTER)
 
         # Process background data
         if back_source == "B":
             if back_sample:
                 background = back_sample.upper().replace(' ', '').replace('\t', '')
             elif back_file and back_file.filename:
-                background = back_file.read().decode('utf-8').upper().replace(' ', '').replace('\t', '')
+                background = read_upload(back_file)
+                if background is None:
+                    return print_error("Background sample too large.")
+                background = background.decode('utf-8').upper().replace(' ', '').replace('\t', '')
             else:
                 return print_error("Background sample missing.")
 
-            sequences = Fasta.read_stream(background)
+            sequences = Fasta.read_stream(io.StringIO(background))
             if not sequences:
                 return print_error("Background sample not in FastA format.")
 
+            background_counts = Fasta.count_chars(sequences, AminoAcid.AA_1_LETTER)
+
         if back_source == "D":
-            sequences = Fasta.read(CompositionProfiler.get_background_file(back_distrib))
+            background_counts = CompositionProfiler.get_background_counts(back_distrib)
 
-        background_counts = Fasta.count_chars(sequences, alphabet)
+        query_counts = Fasta.permute_columns(query_counts, AminoAcid.AA_1_LETTER, alphabet)
+        background_counts = Fasta.permute_columns(background_counts, AminoAcid.AA_1_LETTER, alphabet)
 
         #
         # Look for statistically significant composition differences between two sets
@@ -401,7 +438,8 @@ def profiler():
                                                   groups = AminoAcid.get_groups(),
                                                   group_names = AminoAcid.get_group_names(),
                                                   iterations = iterations,
-                                                  alpha_value = alpha_value)
+                                                  alpha_value = alpha_value,
+                                                  method = 'analytic' if method == 'analytic' else 'permutation')
 
                 styled = (
                     df.style
@@ -452,7 +490,8 @@ def profiler():
                     image_height = image_height,
                     image_width = image_width,
                     resolution = resolution,
-                    iterations = iterations)
+                    iterations = iterations,
+                    method = 'analytic' if method == 'analytic' else 'bootstrap')
 
                 if output_format == 'txt':
                     mimetype = 'text/plain'
@@ -476,10 +515,11 @@ def profiler():
             try:
                 r, pvalue = CompositionProfiler.relent(query_counts,
                                                        background_counts,
-                                                       iterations)
+                                                       iterations,
+                                                       method = 'analytic' if method == 'analytic' else 'permutation')
 
                 html = f'Relative entropy = {r:.3f}<br>'
-                if pvalue > 0:
+                if pvalue > 0 or method == 'analytic':
                     html += f'P-value = {pvalue}<br>'
                 else:
                     html += f'P-value < {1 / iterations}<br>'
@@ -507,6 +547,7 @@ def profiler():
         alpha_value = alpha_value,
         bonferroni = bonferroni,
         iterations = iterations,
+        method = method,
         aa_order = aa_order,
         color_scheme = color_scheme,
         ylab = ylab,
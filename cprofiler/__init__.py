@@ -3,11 +3,15 @@ Composition Profiler
 
 Modules:
     - aminoacid: Collection of amino acid properties and color schemes
+    - cache: On-disk cache of per-sequence count matrices
+    - cluster: Mini-batch k-means clustering of sequences by composition
+    - faidx: Persistent record index of FastA files for memory-mapped counting and random access
     - fasta: Functions for reading, writing and processing FastA files
+    - index: Memory-mapped index of per-sequence compositions for nearest-neighbor search
     - main: Main CLI entry point
     - profile: Functions for discovery, plotting and relative entropy
 
 """
 
-__all__ = ['aminoacid', 'fasta', 'main', 'profile']
+__all__ = ['aminoacid', 'cache', 'cluster', 'faidx', 'fasta', 'index', 'main', 'profile']
 __version__ = "2.0.0"
@@ -391,6 +391,21 @@ class AminoAcid:
         'size_dawson':                'Size (Dawson)'
     }
 
+    # Reduced alphabets, each group of amino acids acting as one symbol
+    AA_REDUCED: Dict[str, List[str]] = {  # Murphy LR, Wallqvist A, Levy RM. (2000)
+        'murphy_4':  ['LVIMC', 'AGSTP', 'FYW', 'EDNQKRH'],
+        'murphy_8':  ['LVIMC', 'AG', 'ST', 'P', 'FYW', 'EDNQ', 'KR', 'H'],
+        'murphy_10': ['LVIM', 'C', 'A', 'G', 'ST', 'P', 'FYW', 'EDNQ', 'KR', 'H'],
+        'murphy_15': ['LVIM', 'C', 'A', 'G', 'S', 'T', 'P', 'FY', 'W', 'E', 'D', 'N', 'Q', 'KR', 'H']
+    }
+
+    AA_REDUCED_NAME: Dict[str, str] = {
+        'murphy_4':  '4 groups (Murphy-Wallqvist-Levy)',
+        'murphy_8':  '8 groups (Murphy-Wallqvist-Levy)',
+        'murphy_10': '10 groups (Murphy-Wallqvist-Levy)',
+        'murphy_15': '15 groups (Murphy-Wallqvist-Levy)'
+    }
+
 
     @staticmethod
     def is_aromatic(aa: str) -> bool:
@@ -506,3 +521,24 @@ class AminoAcid:
         if aa not in scheme:
             raise KeyError(f"Amino acid '{aa}' not found in scheme '{scheme_name}'")
         return scheme[aa]
+
+
+    @staticmethod
+    def list_reduced_alphabets() -> List[str]:
+        """Get a list of all reduced alphabet names"""
+
+        return list(AminoAcid.AA_REDUCED.keys())
+
+    @staticmethod
+    def get_reduced_alphabet_names() -> ItemsView[str, str]:
+        """Get names of all reduced alphabets"""
+
+        return AminoAcid.AA_REDUCED_NAME.items()
+
+    @staticmethod
+    def get_reduced_alphabet(alphabet_name: str) -> List[str]:
+        """Get a specific reduced alphabet by name"""
+
+        if alphabet_name not in AminoAcid.AA_REDUCED:
+            raise KeyError(f"Reduced alphabet '{alphabet_name}' not found")
+        return AminoAcid.AA_REDUCED[alphabet_name]
@@ -0,0 +1,128 @@
+"""
+On-disk cache of per-sequence count matrices
+
+Vladimir Vacic
+Algorithms and Computational Biology Lab
+Department of Computer Science and Engineering
+University of California, Riverside
+Riverside, CA 92521, USA
+"""
+
+import glob
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from cprofiler.aminoacid import AminoAcid
+from cprofiler.fasta import Fasta
+
+
+class CountCache:
+    """On-disk cache of per-sequence count matrices, keyed by FastA file content
+
+    Plain FastA files are counted through their record index instead, which
+    is validated by modification time and size, so they are not hashed."""
+
+    @staticmethod
+    def get_cache_dir() -> Path:
+        """Return the cache directory, honoring CPROFILER_CACHE_DIR and XDG_CACHE_HOME"""
+
+        if os.environ.get('CPROFILER_CACHE_DIR'):
+            return Path(os.environ['CPROFILER_CACHE_DIR'])
+
+        base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+        return Path(base) / 'cprofiler'
+
+    @staticmethod
+    def file_digest(filename: str | Path, block_size: int = 1 << 20) -> str:
+        """Return the SHA-256 hex digest of a file's contents"""
+
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as fin:
+            while block := fin.read(block_size):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def get_cache_file(filename: str | Path) -> Path:
+        """Return the cache file holding counts for the current contents of filename
+
+        Entries are named by the file name, a hash of the resolved path, and a
+        hash of the contents, so files of the same name in other directories
+        keep entries of their own."""
+
+        filename = Path(filename).resolve()
+        key = hashlib.sha256(str(filename).encode('utf-8')).hexdigest()
+        digest = CountCache.file_digest(filename)
+
+        return CountCache.get_cache_dir() / f"{filename.name}.{key[:16]}.{digest[:16]}.npy"
+
+    @staticmethod
+    def count_file(filename: str | Path,
+                   alphabet: str = AminoAcid.AA_1_LETTER,
+                   workers: int = 1) -> np.ndarray:
+        """Count characters of every sequence in a FastA file, using the cache if possible
+
+        Plain files go through FastaIndex.count_file, compressed ones are cached by
+        content hash, and standard input is not cached. Counts are kept in canonical
+        order and served in any reordering of it. An unwritable cache directory only
+        disables caching."""
+
+        if str(filename) == '-' or set(alphabet) - set(AminoAcid.AA_1_LETTER):
+            return Fasta.count_file(filename, alphabet, workers=workers)
+
+        if not Fasta.is_compressed(filename):
+            # FastaIndex keeps its files in the cache directory, so it imports this module
+            from cprofiler.faidx import FastaIndex
+
+            return FastaIndex.count_file(filename, alphabet, workers)
+
+        cache_file = CountCache.get_cache_file(filename)
+
+        try:
+            counts = np.load(cache_file, mmap_mode='r')
+        except (OSError, ValueError):
+            counts = CountCache.update(filename, cache_file, workers)
+
+        return Fasta.permute_columns(counts, AminoAcid.AA_1_LETTER, alphabet)
+
+    @staticmethod
+    def update(filename: str | Path, cache_file: Path, workers: int = 1) -> np.ndarray:
+        """Count a FastA file in canonical order and replace its cache entries"""
+
+        counts = Fasta.count_file(filename, AminoAcid.AA_1_LETTER, workers=workers)
+
+        try:
+            CountCache.store(cache_file, counts)
+        except OSError:
+            return counts
+
+        # Content hash changed, previous entries of the same file are stale
+        prefix = cache_file.name.rsplit('.', 2)[0] + '.'
+        pattern = re.compile(re.escape(prefix) + r'[0-9a-f]{16}\.npy')
+
+        for stale in cache_file.parent.glob(glob.escape(prefix) + '*.npy'):
+            if stale != cache_file and pattern.fullmatch(stale.name):
+                stale.unlink(missing_ok=True)
+
+        return counts
+
+    @staticmethod
+    def store(cache_file: Path, counts: np.ndarray) -> None:
+        """Atomically write a count matrix, so concurrent readers never see a partial file"""
+
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, temp = tempfile.mkstemp(dir=cache_file.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                np.save(fout, counts)
+            os.replace(temp, cache_file)
+        except BaseException:
+            os.unlink(temp)
+            raise
@@ -0,0 +1,117 @@
+"""
+Mini-batch k-means clustering of sequences by composition
+
+Vladimir Vacic
+Algorithms and Computational Biology Lab
+Department of Computer Science and Engineering
+University of California, Riverside
+Riverside, CA 92521, USA
+"""
+
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from cprofiler.aminoacid import AminoAcid
+from cprofiler.fasta import Fasta
+from cprofiler.index import CompositionIndex
+
+
+class CompositionClustering:
+    """Mini-batch k-means over composition vectors (normalized count rows) of
+    sequences streamed from a FastA file, keeping only the centroids in memory"""
+
+    @staticmethod
+    def iter_vectors(filename: str | Path,
+                     alphabet: str,
+                     batch_size: int) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """Yields headers and composition vectors of batches of sequences"""
+
+        with Fasta.open(filename) as fin:
+            for batch in Fasta.iter_batches(Fasta.iter_stream(fin), batch_size):
+                yield [seq.header for seq in batch], \
+                    CompositionIndex.normalize(Fasta.count_chars(batch, alphabet))
+
+    @staticmethod
+    def assign(vectors: np.ndarray, centroids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Nearest centroid of every vector and the Euclidean distance to it"""
+
+        distances = CompositionIndex.distances(centroids, vectors, 'euclidean')
+        labels = np.argmin(distances, axis=1)
+
+        return labels, distances[np.arange(len(vectors)), labels]
+
+    @staticmethod
+    def init_centroids(vectors: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+        """Pick k of the vectors as initial centroids by k-means++ seeding"""
+
+        centroids = [vectors[rng.integers(len(vectors))]]
+        nearest = np.sum((vectors - centroids[0]) ** 2, axis=1)
+
+        for _ in range(1, k):
+            total = np.sum(nearest)
+            i = rng.choice(len(vectors), p=nearest / total) if total > 0 else rng.integers(len(vectors))
+
+            centroids.append(vectors[i])
+            nearest = np.minimum(nearest, np.sum((vectors - vectors[i]) ** 2, axis=1))
+
+        return np.array(centroids)
+
+    @staticmethod
+    def fit(filename: str | Path,
+            k: int,
+            epochs: int = 1,
+            alphabet: str = AminoAcid.AA_1_LETTER,
+            batch_size: int = 4096,
+            seed: int | None = 128) -> np.ndarray:
+        """Learn k centroids from the sequences of a FastA file
+
+        Every epoch is one streaming pass over the file. Each batch moves every
+        centroid towards the mean of the vectors assigned to it, with a step of
+        its batch share over all vectors it has been assigned so far. Centroids
+        are seeded by k-means++ from the first batches holding at least k
+        sequences."""
+
+        rng = np.random.default_rng(seed)
+        centroids = None
+        seen = np.zeros(k)
+        pool = []
+
+        for _ in range(epochs):
+            for _, vectors in CompositionClustering.iter_vectors(filename, alphabet, batch_size):
+                if centroids is None:
+                    pool.append(vectors)
+                    if sum(len(p) for p in pool) < k:
+                        continue
+
+                    vectors = np.concatenate(pool)
+                    centroids = CompositionClustering.init_centroids(vectors, k, rng)
+
+                labels, _ = CompositionClustering.assign(vectors, centroids)
+                onehot = np.zeros((len(vectors), k), dtype=vectors.dtype)
+                onehot[np.arange(len(vectors)), labels] = 1
+
+                counts = np.sum(onehot, axis=0)
+                seen += counts
+
+                updated = counts > 0
+                centroids[updated] += ((onehot.T @ vectors)[updated] -
+                    counts[updated, np.newaxis] * centroids[updated]) / seen[updated, np.newaxis]
+
+            # Later epochs would only pool the same sequences again
+            if centroids is None:
+                raise ValueError(f"Clustering into {k} clusters needs at least {k} sequences")
+
+        return centroids
+
+    @staticmethod
+    def predict(filename: str | Path,
+                centroids: np.ndarray,
+                alphabet: str = AminoAcid.AA_1_LETTER,
+                batch_size: int = 4096) -> Iterator[Tuple[List[str], np.ndarray, np.ndarray]]:
+        """Yields headers, cluster labels and distances to the cluster centroid of
+        batches of sequences of a FastA file"""
+
+        for headers, vectors in CompositionClustering.iter_vectors(filename, alphabet, batch_size):
+            yield (headers,) + CompositionClustering.assign(vectors, centroids)
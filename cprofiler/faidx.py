@@ -0,0 +1,344 @@
+"""
+Persistent record index of FastA files for memory-mapped counting and random access
+
+Vladimir Vacic
+Algorithms and Computational Biology Lab
+Department of Computer Science and Engineering
+University of California, Riverside
+Riverside, CA 92521, USA
+"""
+
+import hashlib
+import mmap
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from cprofiler.aminoacid import AminoAcid
+from cprofiler.cache import CountCache
+from cprofiler.fasta import Fasta, Sequence
+
+
+class FastaIndex:
+    """Record offsets of a FastA file, with the file memory-mapped
+
+    The index is a .fai-style text file with one tab-separated line per record:
+    header, sequence length, byte offset of the sequence, residues and bytes
+    per line (as in samtools faidx, taken from the first sequence line), and
+    the byte offset where the record ends. It is built once, next to the FastA
+    file or in the cache directory, and rebuilt when the file changes. Counts
+    of the records may be stored with it (see count_file)."""
+
+    SUFFIX = '.cfai'
+    WHITESPACE = b' \t\n\v\f\r'
+
+    def __init__(self, filename: str | Path, rebuild: bool = False, cache: bool = False):
+        if Fasta.is_compressed(filename):
+            raise ValueError(f"{filename} is compressed and cannot be memory-mapped")
+
+        self.filename = Path(filename)
+        self.buffer = Fasta.map_file(filename)
+        self.data = np.frombuffer(self.buffer, dtype=np.uint8)
+
+        self.index_file = FastaIndex.get_index_file(filename, cache)
+        self.headers, self.lengths, self.starts, self.ends = \
+            FastaIndex.load_current(filename, self.buffer, rebuild, cache)
+        self.lookup = None
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __getitem__(self, index: int) -> Sequence:
+        """Return record index as a Sequence, sliced from the mapped file"""
+
+        residues = self.buffer[self.starts[index]:self.ends[index]]
+        return Sequence(self.headers[index], residues.translate(None, FastaIndex.WHITESPACE).decode('utf-8'))
+
+    def __iter__(self) -> Iterator[Sequence]:
+        return (self[i] for i in range(len(self)))
+
+    def find(self, header: str) -> int:
+        """Return the number of the record with the given header, raising KeyError if there is none"""
+
+        if self.lookup is None:
+            self.lookup = {h: i for i, h in reversed(list(enumerate(self.headers)))}
+
+        return self.lookup[header]
+
+    def fetch(self, header: str) -> Sequence:
+        """Return the record with the given header"""
+
+        return self[self.find(header)]
+
+    def count_chars(self,
+                    alphabet: str,
+                    start: int = 0,
+                    stop: int | None = None,
+                    batch_bytes: int = 1 << 24) -> np.ndarray:
+        """Count alphabet characters of records start to stop, directly in the mapped file
+
+        Records are counted in batches of about batch_bytes bytes. Within a batch,
+        sequence and header spans alternate, so every other row of the counts of
+        consecutive byte ranges belongs to a sequence; line breaks are not in the
+        alphabet and drop out."""
+
+        stop = len(self) if stop is None else stop
+
+        blocks = []
+        for a, b in FastaIndex.get_batches(self.starts[start:stop], self.ends[start:stop], batch_bytes):
+            bounds = np.empty(2 * (b - a), dtype=np.int64)
+            bounds[0::2] = self.starts[start + a:start + b]
+            bounds[1::2] = self.ends[start + a:start + b]
+
+            blocks.append(Fasta.count_buffer(self.data, bounds, alphabet)[0::2])
+
+        if not blocks:
+            return np.zeros((0, len(alphabet)), dtype=np.uint16)
+
+        return np.concatenate(blocks, axis=0)
+
+    def count_parallel(self, alphabet: str, workers: int = 1) -> np.ndarray:
+        """Count alphabet characters of all records, in ranges from split counted by worker threads"""
+
+        if workers < 2:
+            return self.count_chars(alphabet)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            blocks = list(executor.map(lambda r: self.count_chars(alphabet, *r), self.split(workers)))
+
+        if not blocks:
+            return np.zeros((0, len(alphabet)), dtype=np.uint16)
+
+        return np.concatenate(blocks, axis=0)
+
+    def split(self, parts: int) -> List[Tuple[int, int]]:
+        """Split the records into at most parts consecutive ranges of about equal byte size"""
+
+        if len(self) == 0:
+            return []
+
+        boundaries = np.searchsorted(self.ends, np.linspace(0, self.ends[-1], parts + 1)[1:-1])
+        boundaries = np.unique(np.concatenate(([0], boundaries, [len(self)])))
+
+        return list(zip(boundaries[:-1].tolist(), boundaries[1:].tolist()))
+
+    @staticmethod
+    def get_batches(starts: np.ndarray, ends: np.ndarray, batch_bytes: int) -> Iterator[Tuple[int, int]]:
+        """Yields consecutive ranges of records spanning about batch_bytes bytes each"""
+
+        if len(starts) == 0:
+            return
+
+        cuts = np.searchsorted(ends, np.arange(starts[0] + batch_bytes, ends[-1], batch_bytes)) + 1
+        cuts = np.unique(np.concatenate(([0], np.minimum(cuts, len(starts)), [len(starts)])))
+
+        yield from zip(cuts[:-1].tolist(), cuts[1:].tolist())
+
+    @staticmethod
+    def get_index_file(filename: str | Path, cache: bool = False) -> Path:
+        """Return the index file of a FastA file: next to it if that directory is
+        writable and cache is not set, otherwise in the cache directory under a
+        name keyed by its path"""
+
+        filename = Path(filename).resolve()
+        if not cache and os.access(filename.parent, os.W_OK):
+            return filename.with_name(filename.name + FastaIndex.SUFFIX)
+
+        digest = hashlib.sha256(str(filename).encode('utf-8')).hexdigest()
+        return CountCache.get_cache_dir() / f"{filename.name}.{digest[:16]}{FastaIndex.SUFFIX}"
+
+    @staticmethod
+    def get_counts_file(index_file: Path) -> Path:
+        """Return the file holding the counts stored with an index"""
+
+        return index_file.with_name(index_file.name + '.npy')
+
+    @staticmethod
+    def is_current(filename: str | Path, index_file: Path) -> bool:
+        """Check that an index exists, is not older than its FastA file, and
+        ends where the file does, as changes within the timestamp resolution
+        still change the size. Only the last field of the index is read."""
+
+        try:
+            stat = Path(filename).stat()
+            if index_file.stat().st_mtime_ns < stat.st_mtime_ns:
+                return False
+
+            with open(index_file, 'rb') as fin:
+                fin.seek(max(0, fin.seek(0, os.SEEK_END) - 32))
+                end = fin.read().rstrip(b'\n').rsplit(b'\t', 1)[-1]
+
+            return int(end or 0) == stat.st_size
+        except (OSError, ValueError):
+            return False
+
+    @staticmethod
+    def scan(buffer: mmap.mmap | bytes,
+             block_size: int = 1 << 26) -> Tuple[List[str], np.ndarray, np.ndarray,
+                                                  np.ndarray, np.ndarray, np.ndarray]:
+        """Locate the records of a FastA file held in a buffer
+
+        Returns headers, sequence lengths, sequence offsets, residues and bytes
+        per line, and record ends. Records start at a header line (see
+        Fasta.find_records) and end where the next one starts; residues are
+        the bytes of the sequence lines which are not whitespace. The buffer
+        is scanned in blocks, so temporary arrays stay bounded for files of
+        any size."""
+
+        data = np.frombuffer(buffer, dtype=np.uint8)
+        n = len(data)
+
+        heads, line_ends = Fasta.find_records(buffer, block_size=block_size)
+        ends = np.append(heads[1:], n).astype(np.int64)
+        starts = np.minimum(line_ends + 1, ends)
+
+        # Header lines are gathered into one text, separated by line breaks, and split once
+        headers = []
+        batch = max(1, block_size // 1024)
+        for a in range(0, len(heads), batch):
+            first, last = heads[a:a + batch] + 1, line_ends[a:a + batch]
+            sizes = last - first + 1
+            separators = np.cumsum(sizes) - 1
+
+            positions = np.arange(separators[-1] + 1) - np.repeat(separators - sizes + 1 - first, sizes)
+            text = data[np.minimum(positions, n - 1)]
+            text[separators] = ord('\n')
+
+            headers.extend(header.strip() for header in text.tobytes().decode('utf-8').split('\n')[:-1])
+
+        space = np.zeros(256, dtype=bool)
+        space[list(FastaIndex.WHITESPACE)] = True
+
+        # Sequence and header spans alternate, whitespace in even spans is not sequence
+        bounds = np.empty(2 * len(heads), dtype=np.int64)
+        bounds[0::2] = starts
+        bounds[1::2] = ends
+
+        lengths = ends - starts
+        first_ends = np.full(len(heads), -1, dtype=np.int64)
+        line_bases = np.zeros(len(heads), dtype=np.int64)
+
+        for s in range(int(heads[0]) if len(heads) else n, n, block_size):
+            stop = min(s + block_size, n)
+
+            # Whitespace is all at or below ' ', which is cheaper to compare than to look up
+            blanks = np.flatnonzero(data[s:stop] <= ord(' ')) + s
+            blanks = blanks[space[data[blanks]]]
+
+            span = np.searchsorted(bounds, blanks, side='right') - 1
+            lengths -= np.bincount(span[span % 2 == 0] // 2, minlength=len(heads))
+
+            # The first sequence line of records starting in the block, if it ends there too
+            newlines = blanks[data[blanks] == ord('\n')]
+            inside = np.flatnonzero((starts >= s) & (starts < stop))
+            after = np.append(newlines, n)[np.searchsorted(newlines, starts[inside])]
+            found = (after < ends[inside]) | (ends[inside] <= stop)
+            inside, line_end = inside[found], np.minimum(after[found] + 1, ends[inside[found]])
+
+            first_ends[inside] = line_end
+            line_bases[inside] = line_end - starts[inside] - \
+                (np.searchsorted(blanks, line_end) - np.searchsorted(blanks, starts[inside]))
+
+        # Records without residues, and first lines running past a block
+        for i in np.flatnonzero(first_ends < 0).tolist():
+            line_end = buffer.find(b'\n', int(starts[i]), int(ends[i]))
+            first_ends[i] = ends[i] if line_end < 0 else line_end + 1
+            line_bases[i] = len(buffer[starts[i]:first_ends[i]].translate(None, FastaIndex.WHITESPACE))
+
+        return headers, lengths, starts, line_bases, first_ends - starts, ends
+
+    @staticmethod
+    def build(filename: str | Path, buffer: mmap.mmap | bytes | None = None, cache: bool = False) -> Path:
+        """Index a FastA file, optionally already mapped, and atomically write its index file"""
+
+        if buffer is None:
+            buffer = Fasta.map_file(filename)
+
+        headers, lengths, starts, line_bases, line_widths, ends = FastaIndex.scan(buffer)
+
+        index_file = FastaIndex.get_index_file(filename, cache)
+        index_file.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, temp = tempfile.mkstemp(dir=index_file.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fout:
+                columns = zip(headers, lengths.tolist(), starts.tolist(), line_bases.tolist(),
+                              line_widths.tolist(), ends.tolist())
+                fout.writelines(f"{h}\t{l}\t{s}\t{b}\t{w}\t{e}\n" for h, l, s, b, w, e in columns)
+            os.replace(temp, index_file)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+        # Counts stored with the previous index are stale
+        FastaIndex.get_counts_file(index_file).unlink(missing_ok=True)
+
+        return index_file
+
+    @staticmethod
+    def load_current(filename: str | Path,
+                     buffer: mmap.mmap | bytes,
+                     rebuild: bool = False,
+                     cache: bool = False) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+        """Load the index of a FastA file mapped in buffer, building it first if it is missing or stale"""
+
+        index_file = FastaIndex.get_index_file(filename, cache)
+
+        if not rebuild and FastaIndex.is_current(filename, index_file):
+            return FastaIndex.load(index_file)
+
+        return FastaIndex.load(FastaIndex.build(filename, buffer, cache))
+
+    @staticmethod
+    def load(index_file: Path) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+        """Read headers, sequence lengths, sequence offsets and record ends from an index file"""
+
+        lines = index_file.read_bytes().splitlines()
+        fields = b'\t'.join(lines).split(b'\t')
+
+        # Headers may hold tabs themselves, then each line is split from the right
+        if len(fields) != 6 * len(lines):
+            fields = [field for line in lines for field in line.rsplit(b'\t', 5)]
+
+        headers = [header.decode('utf-8') for header in fields[0::6]]
+        lengths, starts, ends = (np.array(list(map(int, fields[i::6])), dtype=np.int64) for i in (1, 2, 5))
+
+        return headers, lengths, starts, ends
+
+    @staticmethod
+    def count_file(filename: str | Path,
+                   alphabet: str = AminoAcid.AA_1_LETTER,
+                   workers: int = 1) -> np.ndarray:
+        """Count characters of every sequence in a FastA file through its index in
+        the cache directory, reusing the counts stored with it while it is current"""
+
+        if set(alphabet) - set(AminoAcid.AA_1_LETTER):
+            return Fasta.count_file(filename, alphabet, workers=workers)
+
+        index_file = FastaIndex.get_index_file(filename, cache=True)
+        counts_file = FastaIndex.get_counts_file(index_file)
+
+        if FastaIndex.is_current(filename, index_file):
+            try:
+                return Fasta.permute_columns(np.load(counts_file, mmap_mode='r'),
+                                             AminoAcid.AA_1_LETTER, alphabet)
+            except (OSError, ValueError):
+                pass
+
+        # An unwritable cache directory only disables caching
+        try:
+            index = FastaIndex(filename, cache=True)
+        except OSError:
+            return Fasta.count_file(filename, alphabet, workers=workers)
+
+        counts = index.count_parallel(AminoAcid.AA_1_LETTER, workers)
+        try:
+            CountCache.store(counts_file, counts)
+        except OSError:
+            pass
+
+        return Fasta.permute_columns(counts, AminoAcid.AA_1_LETTER, alphabet)
@@ -8,12 +8,25 @@ University of California, Riverside
 Riverside, CA 92521, USA
 """
 
+import bz2
+import contextlib
+import gzip
+import io
+import itertools
+import lzma
+import mmap
+import os
+import sys
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, TextIO
+from typing import BinaryIO, Iterable, Iterator, List, TextIO, Tuple
 
 import numpy as np
 
+from cprofiler.aminoacid import AminoAcid
+
 
 @dataclass
 class Sequence:
@@ -25,33 +38,222 @@ class Sequence:
     def count_chars(self, alphabet: str) -> np.ndarray:
         """Count occurences of each character in the alphabet in the given Sequence"""
 
-        counts = {ch: 0 for ch in alphabet}
-        for ch in self.sequence:
-            if ch in alphabet:   # Silently skip unknown symbols
-                counts[ch] += 1
+        return Fasta.count_chars([self], alphabet)[0]
+
+    def window_counts(self, alphabet: str, width: int) -> np.ndarray:
+        """Count occurences of each character in the alphabet in every window of the Sequence"""
+
+        return Fasta.window_counts(self.sequence, alphabet, width)
+
+
+class SequenceView:
+    """Read-only view of one record of a SequenceStore, usable in place of a Sequence"""
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store: 'SequenceStore', index: int):
+        self.store = store
+        self.index = index
+
+    @property
+    def header(self) -> str:
+        return self.store.get_header(self.index)
+
+    @property
+    def sequence(self) -> str:
+        return self.store.get_sequence(self.index)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (Sequence, SequenceView)):
+            return NotImplemented
+        return (self.header, self.sequence) == (other.header, other.sequence)
+
+    def __repr__(self) -> str:
+        return f"SequenceView(header={self.header!r}, sequence={self.sequence!r})"
+
+    def count_chars(self, alphabet: str) -> np.ndarray:
+        """Count occurences of each character in the alphabet in the viewed sequence"""
+
+        return Fasta.count_buffer(self.store.buffer, self.store.offsets[self.index:self.index + 2],
+                                  alphabet)[0]
+
+    def window_counts(self, alphabet: str, width: int) -> np.ndarray:
+        """Count occurences of each character in the alphabet in every window of the viewed sequence"""
+
+        return Fasta.window_counts(self.sequence, alphabet, width)
+
+
+class SequenceStore:
+    """Collection of sequences kept in one contiguous buffer of residues and one
+    of headers, with offsets of every record into each
+
+    Behaves as a read-only list of SequenceViews, created on access, so a record
+    costs two offsets instead of a Sequence with two strings. Slices are
+    SequenceStores sharing the buffers."""
+
+    __slots__ = ('buffer', 'offsets', 'header_buffer', 'header_offsets')
+
+    def __init__(self, buffer: bytes, offsets: np.ndarray, header_buffer: bytes, header_offsets: np.ndarray):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.header_buffer = header_buffer
+        self.header_offsets = header_offsets
+
+    @staticmethod
+    def from_sequences(sequences: Iterable[Sequence]) -> 'SequenceStore':
+        """Pack sequences into a store, without holding on to any per-record objects"""
+
+        buffer, header_buffer = bytearray(), bytearray()
+        offsets, header_offsets = array('q', [0]), array('q', [0])
+
+        for seq in sequences:
+            buffer += seq.sequence.encode('utf-8')
+            header_buffer += seq.header.encode('utf-8')
+            offsets.append(len(buffer))
+            header_offsets.append(len(header_buffer))
+
+        return SequenceStore(bytes(buffer), np.frombuffer(offsets, dtype=np.int64),
+                             bytes(header_buffer), np.frombuffer(header_offsets, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
 
-        t = np.zeros(len(alphabet))
-        for i in range(len(alphabet)):
-            t[i] = counts.get(alphabet[i], 0)
+    def __getitem__(self, index: int | slice) -> 'SequenceView | SequenceStore':
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return SequenceStore.from_sequences(self[i] for i in range(start, stop, step))
 
-        return t
+            stop = max(start, stop)
+            return SequenceStore(self.buffer, self.offsets[start:stop + 1],
+                                 self.header_buffer, self.header_offsets[start:stop + 1])
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("SequenceStore index out of range")
+
+        return SequenceView(self, index)
+
+    def __iter__(self) -> Iterator[SequenceView]:
+        return (SequenceView(self, i) for i in range(len(self)))
+
+    def get_sequence(self, index: int) -> str:
+        """Return the sequence of record index"""
+
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]].decode('utf-8')
+
+    def get_header(self, index: int) -> str:
+        """Return the header of record index"""
+
+        return self.header_buffer[self.header_offsets[index]:self.header_offsets[index + 1]].decode('utf-8')
 
 
 class Fasta:
     """Class for reading, writing and processing FastA format files"""
 
+    # Leading bytes of compressed files
+    MAGIC = {
+        'gzip': b'\x1f\x8b',
+        'bz2': b'BZh',
+        'xz': b'\xfd7zXZ\x00',
+        'zstd': b'\x28\xb5\x2f\xfd'
+    }
+
+    BUFFER_SIZE = 1 << 20
+
+    # ASCII characters which str.strip() removes, and line breaks of text mode reading
+    WHITESPACE = b' \t\n\v\f\r\x1c\x1d\x1e\x1f'
+    LINE_BREAKS = b'\n\r'
+
+    @staticmethod
+    def get_compression(magic: bytes) -> str | None:
+        """Name of the compression format starting with the given bytes, None for plain files"""
+
+        for name, prefix in Fasta.MAGIC.items():
+            if magic.startswith(prefix):
+                return name
+
+        return None
+
+    @staticmethod
+    def is_compressed(filename: str | Path) -> bool:
+        """Check whether a file is compressed, by its leading bytes"""
+
+        with open(filename, 'rb') as fin:
+            return Fasta.get_compression(fin.read(6)) is not None
+
     @staticmethod
-    def read(filename: str):
-        """Reads a FastA file and returns a list of Sequences"""
+    def decompress_stream(fin: BinaryIO) -> BinaryIO:
+        """Wrap a binary stream in a decompressor chosen by its leading bytes
+
+        Plain streams are returned buffered as they are. Data is read and
+        decompressed in blocks of BUFFER_SIZE bytes. zstd needs the optional
+        zstandard package."""
+
+        if not hasattr(fin, 'peek'):
+            fin = io.BufferedReader(fin, buffer_size=Fasta.BUFFER_SIZE)
+
+        compression = Fasta.get_compression(fin.peek(6)[:6])
+
+        if compression == 'gzip':
+            fin = gzip.GzipFile(fileobj=fin, mode='rb')
+        elif compression == 'bz2':
+            fin = bz2.BZ2File(fin, mode='rb')
+        elif compression == 'xz':
+            fin = lzma.LZMAFile(fin, mode='rb')
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("Reading zstd compressed files requires the zstandard package")
+
+            fin = zstandard.ZstdDecompressor().stream_reader(fin, read_size=Fasta.BUFFER_SIZE, closefd=True)
+        else:
+            return fin
+
+        return io.BufferedReader(fin, buffer_size=Fasta.BUFFER_SIZE)
+
+    @staticmethod
+    def open(filename: str | Path) -> TextIO:
+        """Open a FastA file for reading as text, '-' meaning standard input
+
+        Compressed files (gzip, bz2, xz or zstd) are recognized by their leading
+        bytes and decompressed while they are read."""
 
-        with open(filename, "r") as fin:
+        if str(filename) == '-':
+            fin = sys.stdin.buffer
+        else:
+            fin = open(filename, 'rb', buffering=Fasta.BUFFER_SIZE)
+
+        return io.TextIOWrapper(Fasta.decompress_stream(fin), encoding='utf-8')
+
+    @staticmethod
+    def read(filename: str) -> SequenceStore:
+        """Reads a FastA file and returns its sequences in a SequenceStore"""
+
+        with Fasta.open(filename) as fin:
             return Fasta.read_stream(fin)
 
     @staticmethod
-    def read_stream(fin: TextIO) -> List[Sequence]:
-        """Reads sequences from an open file handle"""
+    def read_stream(fin: TextIO) -> SequenceStore:
+        """Reads sequences from an open file handle into a SequenceStore"""
+
+        return SequenceStore.from_sequences(Fasta.iter_stream(fin))
+
+    @staticmethod
+    def iter(filename: str) -> Iterator[Sequence]:
+        """Reads a FastA file and yields Sequences one at a time"""
 
-        sequences = []
+        with Fasta.open(filename) as fin:
+            yield from Fasta.iter_stream(fin)
+
+    @staticmethod
+    def iter_stream(fin: TextIO) -> Iterator[Sequence]:
+        """Yields sequences from an open file handle one at a time"""
+
+        header = None
+        chunks = []
 
         for line in fin:
             line = line.strip()
@@ -59,35 +261,540 @@ class Fasta:
                 continue
 
             if line.startswith('>'):
+                if header is not None:
+                    yield Sequence(header, ''.join(chunks))
+
                 # New sequence header
                 header = line[1:].strip()
-                sequences.append(Sequence(header, ""))
-            elif sequences:  # Only append sequence if we've seen a header
-                sequences[-1].sequence += line
+                chunks = []
+            elif header is not None:  # Only append sequence if we've seen a header
+                chunks.append(line)
+
+        if header is not None:
+            yield Sequence(header, ''.join(chunks))
+
+    @staticmethod
+    def iter_batches(sequences: Iterable[Sequence],
+                     batch_size: int = 4096) -> Iterator[List[Sequence]]:
+        """Groups a stream of sequences into lists of at most batch_size Sequences"""
+
+        batch = []
+        for seq in sequences:
+            batch.append(seq)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    @staticmethod
+    def write(sequences: Iterable[Sequence] | SequenceStore,
+              filename: str | Path,
+              width: int = 80,
+              batch_bytes: int = 1 << 22) -> None:
+        """Writes sequences to a file in FastA format
+
+        Each record is a header line, sequence lines of width characters and a
+        blank line. Records are formatted in batches of about batch_bytes
+        residues into one buffer each (see format_store), so sequences can come
+        from any iterable, such as Fasta.iter, without being held in memory.
+        The output is compressed by file extension (see open_output)."""
+
+        if isinstance(sequences, SequenceStore):
+            batches = Fasta.iter_store_batches(sequences, batch_bytes)
+        else:
+            batches = Fasta.iter_sequence_batches(sequences, batch_bytes)
+
+        with Fasta.open_output(filename) as fout:
+            for store in batches:
+                fout.write(Fasta.format_store(store, width))
+
+    @staticmethod
+    def open_output(filename: str | Path) -> BinaryIO:
+        """Open a file for writing bytes, '-' meaning standard output
+
+        Files ending in .gz, .bz2, .xz or .zst are compressed; zstd needs the
+        optional zstandard package."""
+
+        if str(filename) == '-':
+            return contextlib.nullcontext(sys.stdout.buffer)
+
+        suffix = Path(filename).suffix
+        if suffix == '.gz':
+            return gzip.open(filename, 'wb', compresslevel=6)
+        if suffix == '.bz2':
+            return bz2.open(filename, 'wb')
+        if suffix == '.xz':
+            return lzma.open(filename, 'wb')
+        if suffix == '.zst':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("Writing zstd compressed files requires the zstandard package")
+
+            return zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'), closefd=True)
+
+        return open(filename, 'wb', buffering=Fasta.BUFFER_SIZE)
+
+    @staticmethod
+    def iter_store_batches(store: SequenceStore, batch_bytes: int) -> Iterator[SequenceStore]:
+        """Yields consecutive slices of a store holding about batch_bytes residues each"""
+
+        offsets = store.offsets
+        cuts = np.searchsorted(offsets, np.arange(offsets[0] + batch_bytes, offsets[-1], batch_bytes))
+        cuts = np.unique(np.concatenate(([0], cuts, [len(store)])))
+
+        for a, b in zip(cuts[:-1].tolist(), cuts[1:].tolist()):
+            yield store[a:b]
+
+    @staticmethod
+    def iter_sequence_batches(sequences: Iterable[Sequence], batch_bytes: int) -> Iterator[SequenceStore]:
+        """Packs a stream of sequences into stores holding about batch_bytes residues each"""
+
+        batch, size = [], 0
+        for seq in sequences:
+            batch.append(seq)
+            size += len(seq.sequence)
+            if size >= batch_bytes:
+                yield SequenceStore.from_sequences(batch)
+                batch, size = [], 0
+
+        if batch:
+            yield SequenceStore.from_sequences(batch)
+
+    @staticmethod
+    def format_store(store: SequenceStore, width: int = 80) -> np.ndarray:
+        """Format all records of a store in FastA format, as one array of bytes
+
+        The array starts out as line breaks. '>' and headers are scattered into
+        it, and residues fill every position that is left, through a mask; so
+        only headers and line breaks are located individually, not residues."""
+
+        n = len(store)
+        if n == 0:
+            return np.zeros(0, dtype=np.uint8)
+
+        offsets, header_offsets = store.offsets, store.header_offsets
+        residues = np.frombuffer(store.buffer, dtype=np.uint8)[offsets[0]:offsets[-1]]
+        headers = np.frombuffer(store.header_buffer, dtype=np.uint8)[header_offsets[0]:header_offsets[-1]]
+
+        lengths = np.diff(offsets)
+        header_lengths = np.diff(header_offsets)
+        lines = -(-lengths // width)
+
+        # '>', header, line break, sequence lines with their breaks, blank line
+        sizes = header_lengths + lengths + lines + 3
+        starts = np.zeros(n, dtype=np.int64)
+        np.cumsum(sizes[:-1], out=starts[1:])
+        seq_starts = starts + header_lengths + 2
+
+        header_pos = np.arange(len(headers)) + np.repeat(starts + 1 - (header_offsets[:-1] - header_offsets[0]),
+                                                         header_lengths)
+
+        # Line k of a sequence ends after min(width, length - k * width) residues
+        k = np.arange(np.sum(lines)) - np.repeat(np.cumsum(lines) - lines, lines)
+        break_pos = np.repeat(seq_starts, lines) + k * (width + 1) + \
+            np.minimum(width, np.repeat(lengths, lines) - k * width)
+
+        out = np.full(np.sum(sizes), ord('\n'), dtype=np.uint8)
+        out[starts] = ord('>')
+        out[header_pos] = headers
+
+        is_residue = np.ones(len(out), dtype=bool)
+        for pos in (starts, header_pos, seq_starts - 1, break_pos, starts + sizes - 1):
+            is_residue[pos] = False
+        out[is_residue] = residues
+
+        return out
+
+    @staticmethod
+    def lookup_table(alphabet: str | List[str]) -> np.ndarray:
+        """Map every byte value to its column in the alphabet, or -1 for unknown symbols
+
+        The alphabet is a string of symbols or, for reduced alphabets, a list of
+        strings whose characters all map to the same column."""
+
+        table = np.full(256, -1, dtype=np.intp)
+        for i, symbols in enumerate(alphabet):
+            for ch in symbols.encode('ascii'):
+                table[ch] = i
 
-        return sequences
+        return table
 
     @staticmethod
-    def write(sequences: List[Sequence], filename: str | Path) -> None:
-        """Writes sequences to a file in FastA format"""
+    def count_buffer(buffer: bytes | np.ndarray,
+                     offsets: np.ndarray,
+                     alphabet: str,
+                     batch_bytes: int = 1 << 22) -> np.ndarray:
+        """Count alphabet characters in consecutive byte ranges of a buffer
 
-        with open(filename, "w") as fout:
-            for seq in sequences:
-                fout.write(f">{seq.header}\n")
+        Record i spans buffer[offsets[i]:offsets[i+1]]. The buffer is counted in
+        vectorized passes over pieces of batch_bytes bytes, so temporaries stay
+        bounded. Counts are uint16 when no record is longer than 65535
+        characters, and uint32 otherwise."""
 
-                # Split sequence into chunks of 80 characters
-                for i in range(0, len(seq.sequence), 80):
-                    fout.write(f"{seq.sequence[i:i+80]}\n")
+        buffer = np.frombuffer(buffer, dtype=np.uint8) if isinstance(buffer, bytes) else buffer
+        offsets = np.asarray(offsets, dtype=np.intp)
+        n, k = len(offsets) - 1, len(alphabet)
 
-                fout.write("\n")
+        if n < 1:
+            return np.zeros((0, k), dtype=np.uint16)
+
+        dtype = np.uint16 if np.max(np.diff(offsets)) <= np.iinfo(np.uint16).max else np.uint32
+        counts = np.zeros((n, k), dtype=dtype)
+
+        # Unknown symbols go to an extra column which is dropped at the end
+        table = Fasta.lookup_table(alphabet)
+        table[table < 0] = k
+        table = table.astype(np.uint8 if k < 255 else np.int32)
+
+        for a in range(int(offsets[0]), int(offsets[-1]), batch_bytes):
+            b = min(a + batch_bytes, int(offsets[-1]))
+
+            # Records overlapping the piece, the first and last possibly in part
+            first = int(np.searchsorted(offsets, a, side='right')) - 1
+            last = int(np.searchsorted(offsets, b, side='left'))
+            m = last - first
+
+            row_type = np.int32 if m * (k + 1) < 2 ** 31 else np.int64
+            rows = np.repeat(np.arange(m, dtype=row_type), np.diff(np.clip(offsets[first:last + 1], a, b)))
+            t = np.bincount(rows * (k + 1) + table[buffer[a:b]], minlength=m * (k + 1))
+
+            counts[first:last] += t.reshape(m, k + 1)[:, :k].astype(dtype)
+
+        return counts
 
     @staticmethod
-    def count_chars(sequences: List[Sequence], alphabet: str) -> np.ndarray:
+    def count_chars(sequences: List[Sequence] | SequenceStore, alphabet: str) -> np.ndarray:
         """Count occurences of each character in the alphabet across all sequences"""
 
-        t = np.zeros((len(sequences), len(alphabet)))
+        # Stores are counted in place
+        if isinstance(sequences, SequenceStore):
+            return Fasta.count_buffer(sequences.buffer, sequences.offsets, alphabet)
+
+        # Non-ASCII symbols can never match the alphabet, so dropping them is safe
+        chunks = [seq.sequence.encode('ascii', errors='ignore') for seq in sequences]
+
+        offsets = np.zeros(len(chunks) + 1, dtype=np.intp)
+        np.cumsum([len(chunk) for chunk in chunks], out=offsets[1:])
+
+        return Fasta.count_buffer(b''.join(chunks), offsets, alphabet)
+
+    @staticmethod
+    def permute_columns(counts: np.ndarray, source: str, target: str) -> np.ndarray:
+        """Reorder count columns from the source alphabet ordering to the target ordering
+
+        Returns counts itself when the orderings match and a strided view when the
+        target is an evenly spaced selection (e.g. the reverse) of the source."""
+
+        if source == target:
+            return counts
+
+        try:
+            cols = [source.index(ch) for ch in target]
+        except ValueError:
+            raise ValueError(f"Alphabet {target} is not a reordering of {source}") from None
+
+        steps = np.diff(cols)
+        if len(cols) > 1 and steps[0] != 0 and (steps == steps[0]).all():
+            stop = cols[-1] + steps[0]
+            return counts[:, cols[0]:(stop if stop >= 0 else None):steps[0]]
+
+        return counts[:, cols]
+
+    @staticmethod
+    def count_stream(fin: TextIO, alphabet: str, batch_size: int = 4096) -> np.ndarray:
+        """Count characters of every sequence in an open file handle
+
+        Sequences are parsed and counted in batches, so only the count rows,
+        and not the sequences themselves, are kept in memory."""
+
+        blocks = [Fasta.count_chars(batch, alphabet)
+                  for batch in Fasta.iter_batches(Fasta.iter_stream(fin), batch_size)]
+
+        if not blocks:
+            return np.zeros((0, len(alphabet)), dtype=np.uint16)
+
+        return np.concatenate(blocks, axis=0)
+
+    @staticmethod
+    def count_file(filename: str | Path,
+                   alphabet: str,
+                   batch_size: int = 4096,
+                   workers: int = 1) -> np.ndarray:
+        """Count characters of every sequence in a FastA file
+
+        With more than one worker, a plain memory-mapped file is counted in
+        parallel by byte ranges (see count_parallel). Compressed files and
+        standard input are streamed."""
+
+        if workers > 1 and str(filename) != '-' and not Fasta.is_compressed(filename):
+            return Fasta.count_parallel(filename, alphabet, workers)
+
+        with Fasta.open(filename) as fin:
+            return Fasta.count_stream(fin, alphabet, batch_size)
+
+    @staticmethod
+    def map_file(filename: str | Path) -> mmap.mmap | bytes:
+        """Memory-map a file read-only; empty files, which cannot be mapped, give empty bytes"""
+
+        with open(filename, 'rb') as fin:
+            if os.fstat(fin.fileno()).st_size == 0:
+                return b''
+
+            return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def find_records(buffer: mmap.mmap | bytes,
+                     start: int = 0,
+                     stop: int | None = None,
+                     block_size: int = 1 << 26) -> Tuple[np.ndarray, np.ndarray]:
+        """Locate the record headers in buffer[start:stop] of a FastA buffer
+
+        A header is a line whose first non-whitespace character is '>', and
+        lines end at '\\n' or '\\r', so records are the ones iter_stream reads.
+        Returns the offsets of the '>' of every header and of the end of its
+        line (stop if the line is not terminated). The buffer is scanned in
+        blocks, so temporary arrays stay bounded for buffers of any size."""
+
+        stop = len(buffer) if stop is None else stop
+        data = np.frombuffer(buffer, dtype=np.uint8)
+
+        space = np.zeros(256, dtype=bool)
+        space[list(Fasta.WHITESPACE)] = True
+        line_break = np.zeros(256, dtype=bool)
+        line_break[list(Fasta.LINE_BREAKS)] = True
+
+        heads, line_ends = [], []
+        for s in range(start, stop, block_size):
+            block = data[s:min(s + block_size, stop)]
+
+            gt = np.flatnonzero(block == ord('>')) + s
+            previous = data[np.maximum(gt - 1, 0)]
+            is_head = (gt == 0) | line_break[previous]
+
+            # Indented headers, with only whitespace before '>'
+            for i in np.flatnonzero(~is_head & space[previous]).tolist():
+                g = int(gt[i])
+                line_start = buffer.rfind(b'\n', 0, g) + 1
+                line_start = max(line_start, buffer.rfind(b'\r', line_start, g) + 1)
+                is_head[i] = not buffer[line_start:g].strip(Fasta.WHITESPACE)
+
+            gt = gt[is_head]
+
+            # A comparison is much cheaper than a table lookup of every byte
+            breaks = np.flatnonzero(block <= ord('\r')) + s
+            breaks = breaks[line_break[data[breaks]]]
+            ends = np.append(breaks, -1)[np.searchsorted(breaks, gt)]
+
+            # Header lines running past the block
+            for i in np.flatnonzero(ends < 0).tolist():
+                g = int(gt[i])
+                line_end = buffer.find(b'\n', g, stop)
+                line_end = stop if line_end < 0 else line_end
+                carriage_return = buffer.find(b'\r', g, line_end)
+                ends[i] = line_end if carriage_return < 0 else carriage_return
+
+            heads.append(gt)
+            line_ends.append(ends)
+
+        if not heads:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        return np.concatenate(heads).astype(np.int64), np.concatenate(line_ends).astype(np.int64)
+
+    @staticmethod
+    def split_ranges(buffer: mmap.mmap | bytes, parts: int, window: int = 1 << 16) -> List[Tuple[int, int]]:
+        """Split a FastA buffer into at most parts byte ranges of about equal size,
+        each starting at a record header (see find_records)"""
+
+        boundaries = [0]
+        for i in range(1, parts):
+            heads = []
+            for pos in range(max(boundaries[-1] + 1, len(buffer) * i // parts), len(buffer), window):
+                heads, _ = Fasta.find_records(buffer, pos, min(pos + window, len(buffer)))
+                if len(heads):
+                    break
+
+            if not len(heads):
+                break
+            boundaries.append(int(heads[0]))
+
+        boundaries.append(len(buffer))
+        boundaries = sorted(set(boundaries))
+
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    @staticmethod
+    def count_range(buffer: mmap.mmap | bytes, start: int, stop: int, alphabet: str) -> np.ndarray:
+        """Count alphabet characters of the records in a byte range of a FastA buffer
+
+        Records run from a header line to the next one, so the range has to
+        start at a record. Sequence and header spans alternate, and every other
+        row of the counts of those consecutive spans belongs to a sequence."""
+
+        heads, line_ends = Fasta.find_records(buffer, start, stop)
+
+        if len(heads) == 0:
+            return np.zeros((0, len(alphabet)), dtype=np.uint16)
+
+        bounds = np.empty(2 * len(heads), dtype=np.int64)
+        bounds[0::2] = np.minimum(line_ends + 1, stop)
+        bounds[1::2] = np.append(heads[1:], stop)
+
+        return Fasta.count_buffer(np.frombuffer(buffer, dtype=np.uint8), bounds, alphabet)[0::2]
+
+    @staticmethod
+    def count_parallel(filename: str | Path,
+                       alphabet: str,
+                       workers: int,
+                       chunk_bytes: int = 1 << 24) -> np.ndarray:
+        """Count characters of every sequence in a FastA file with worker threads
+
+        The memory-mapped file is split into byte ranges of about chunk_bytes,
+        aligned on records, which are counted by count_range in worker threads
+        (the vectorized counting releases the GIL) and concatenated in file
+        order."""
+
+        buffer = Fasta.map_file(filename)
+        ranges = Fasta.split_ranges(buffer, max(workers, -(-len(buffer) // chunk_bytes)))
+
+        def count(byte_range: Tuple[int, int]) -> np.ndarray:
+            return Fasta.count_range(buffer, *byte_range, alphabet)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            blocks = list(executor.map(count, ranges))
+
+        if not blocks:
+            return np.zeros((0, len(alphabet)), dtype=np.uint16)
+
+        return np.concatenate(blocks, axis=0)
+
+    @staticmethod
+    def window_counts(sequence: str, alphabet: str, width: int) -> np.ndarray:
+        """Count alphabet characters in every window of width characters of a sequence
+
+        Row i holds the counts of sequence[i:i+width]. Windows are differences
+        of cumulative sums of one-hot rows, so all of them take O(L) time.
+        Sequences shorter than width have no windows."""
+
+        k = len(alphabet)
+        data = np.frombuffer(sequence.encode('ascii', errors='replace'), dtype=np.uint8)
+
+        if len(data) < width:
+            return np.zeros((0, k), dtype=np.int64)
+
+        # Unknown symbols go to an extra column which is dropped at the end
+        table = Fasta.lookup_table(alphabet)
+        table[table < 0] = k
+
+        onehot = np.zeros((len(data) + 1, k + 1), dtype=np.int64)
+        onehot[np.arange(1, len(data) + 1), table[data]] = 1
+        np.cumsum(onehot, axis=0, out=onehot)
+
+        return (onehot[width:] - onehot[:-width])[:, :k]
+
+    @staticmethod
+    def window_weights(alphabet: str,
+                       groups: List[str] = (),
+                       properties: List[str] = ()) -> np.ndarray:
+        """Columns of per-character weights, averaged over windows by iter_windows
+
+        Each group in AminoAcid.AA_GROUP gives a 0/1 membership column, whose
+        average is the fraction of the group, and each property in
+        AminoAcid.AA_PROPERTY a column of property values. Without groups and
+        properties, the identity gives the fraction of every character."""
+
+        if not groups and not properties:
+            return np.eye(len(alphabet))
+
+        columns = [[float(ch in AminoAcid.AA_GROUP[group]) for ch in alphabet] for group in groups]
+        columns += [[AminoAcid.get_property(name, ch) for ch in alphabet] for name in properties]
+
+        return np.array(columns).T
+
+    @staticmethod
+    def iter_windows(sequences: Iterable[Sequence],
+                     alphabet: str,
+                     width: int,
+                     weights: np.ndarray) -> Iterator[Tuple[Sequence, np.ndarray]]:
+        """Yields every sequence with averages of the weight columns over its windows
+
+        Averages are taken over the alphabet characters of a window; windows
+        without any give nan."""
+
+        for seq in sequences:
+            counts = Fasta.window_counts(seq.sequence, alphabet, width)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                yield seq, (counts @ weights) / np.sum(counts, axis=1, keepdims=True)
+
+    @staticmethod
+    def kmer_names(alphabet: str | List[str], k: int) -> List[str]:
+        """Names of the k-mer columns of count_kmers, groups of reduced alphabets in brackets"""
+
+        symbols = [group if len(group) == 1 else f'[{group}]' for group in alphabet]
+        return [''.join(kmer) for kmer in itertools.product(symbols, repeat=k)]
+
+    @staticmethod
+    def count_kmers(sequences: List[Sequence] | SequenceStore, alphabet: str | List[str], k: int) -> np.ndarray:
+        """Count overlapping k-mers of alphabet symbols in every sequence
+
+        Columns follow kmer_names. Sequences are encoded into one byte buffer and
+        every k-mer gets an integer code, built by rolling over the k shifted
+        symbol codes; all k-mers are then counted with a single bincount.
+        K-mers spanning unknown symbols are skipped."""
+
+        size = len(alphabet)
+        n_kmers = size ** k
+
+        if isinstance(sequences, SequenceStore):
+            buffer = sequences.buffer[sequences.offsets[0]:sequences.offsets[-1]]
+            lengths = np.diff(sequences.offsets)
+        else:
+            chunks = [seq.sequence.encode('ascii', errors='replace') for seq in sequences]
+            buffer = b''.join(chunks)
+            lengths = np.array([len(chunk) for chunk in chunks], dtype=np.intp)
+
+        codes = Fasta.lookup_table(alphabet)[np.frombuffer(buffer, dtype=np.uint8)]
+        m = len(codes) - k + 1
+
+        if m < 1:
+            return np.zeros((len(lengths), n_kmers), dtype=np.uint32)
+
+        kmers = np.zeros(m, dtype=np.int64)
+        valid = np.ones(m, dtype=bool)
+        for j in range(k):
+            kmers = kmers * size + codes[j:j + m]
+            valid &= codes[j:j + m] >= 0
+
+        # K-mers must start and end in the same sequence
+        rows = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+        valid &= rows[0:m] == rows[k - 1:]
+
+        counts = np.bincount(rows[0:m][valid] * n_kmers + kmers[valid], minlength=len(lengths) * n_kmers)
+
+        return counts.reshape(len(lengths), n_kmers).astype(np.uint32)
+
+    @staticmethod
+    def count_kmers_file(filename: str | Path,
+                         alphabet: str | List[str],
+                         k: int,
+                         batch_size: int | None = None) -> np.ndarray:
+        """Count k-mers of every sequence in a FastA file
+
+        Sequences are counted in batches, by default small enough that the
+        counts of a batch take about 32MB while they are tallied."""
+
+        if batch_size is None:
+            batch_size = max(1, 2 ** 22 // len(alphabet) ** k)
+
+        with Fasta.open(filename) as fin:
+            blocks = [Fasta.count_kmers(batch, alphabet, k)
+                      for batch in Fasta.iter_batches(Fasta.iter_stream(fin), batch_size)]
 
-        for i in range(len(sequences)):
-            t[i,] = sequences[i].count_chars(alphabet)
+        if not blocks:
+            return np.zeros((0, len(alphabet) ** k), dtype=np.uint32)
 
-        return t
+        return np.concatenate(blocks, axis=0)
@@ -0,0 +1,170 @@
+"""
+Memory-mapped index of per-sequence compositions for nearest-neighbor search
+
+Vladimir Vacic
+Algorithms and Computational Biology Lab
+Department of Computer Science and Engineering
+University of California, Riverside
+Riverside, CA 92521, USA
+"""
+
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+from cprofiler.aminoacid import AminoAcid
+from cprofiler.fasta import Fasta
+
+
+class CompositionIndex:
+    """Composition vectors (normalized count rows) of a FastA file, stored as a
+    float32 .npy matrix which is memory-mapped, with sequence headers kept as one
+    byte string and offsets into it"""
+
+    METRICS = ['l1', 'euclidean', 'kl']
+
+    def __init__(self, path: str | Path):
+        path = Path(path)
+
+        self.alphabet = (path / 'alphabet.txt').read_text().strip()
+        self.frequencies = np.load(path / 'frequencies.npy', mmap_mode='r')
+        self.offsets = np.load(path / 'offsets.npy')
+
+        if self.offsets[-1] > 0:
+            self.headers = np.memmap(path / 'headers.txt', dtype=np.uint8, mode='r')
+        else:
+            self.headers = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.frequencies)
+
+    def get_header(self, i: int) -> str:
+        """Return the header of the i-th indexed sequence"""
+
+        return self.headers[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    @staticmethod
+    def normalize(counts: np.ndarray) -> np.ndarray:
+        """Divide count rows by their sums, leaving rows without residues at zero"""
+
+        totals = np.sum(counts, axis=1, keepdims=True)
+        return (counts / np.maximum(totals, 1)).astype(np.float32)
+
+    @staticmethod
+    def build(filename: str | Path,
+              path: str | Path,
+              alphabet: str = AminoAcid.AA_1_LETTER,
+              batch_size: int = 4096) -> 'CompositionIndex':
+        """Build an index of a FastA file in directory path
+
+        Sequences are streamed in batches, and vectors and headers are appended
+        to disk as they are counted, so memory does not grow with the file."""
+
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        n = 0
+        offsets = [np.zeros(1, dtype=np.int64)]
+
+        with Fasta.open(filename) as fin, \
+                open(path / 'frequencies.tmp', 'wb') as fvec, \
+                open(path / 'headers.txt', 'wb') as fhead:
+            for batch in Fasta.iter_batches(Fasta.iter_stream(fin), batch_size):
+                fvec.write(CompositionIndex.normalize(Fasta.count_chars(batch, alphabet)).tobytes())
+
+                headers = [seq.header.encode('utf-8') for seq in batch]
+                fhead.write(b''.join(headers))
+
+                lengths = np.cumsum([len(header) for header in headers], dtype=np.int64)
+                offsets.append(offsets[-1][-1] + lengths)
+                n += len(batch)
+
+        # The number of rows is only known now, so the .npy header goes in front of the raw rows
+        with open(path / 'frequencies.npy', 'wb') as fout, open(path / 'frequencies.tmp', 'rb') as fin:
+            np.lib.format.write_array_header_1_0(fout, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                'fortran_order': False,
+                'shape': (n, len(alphabet))})
+            shutil.copyfileobj(fin, fout)
+
+        os.unlink(path / 'frequencies.tmp')
+
+        np.save(path / 'offsets.npy', np.concatenate(offsets))
+        (path / 'alphabet.txt').write_text(alphabet + '\n')
+
+        return CompositionIndex(path)
+
+    @staticmethod
+    def distances(block: np.ndarray, queries: np.ndarray, metric: str) -> np.ndarray:
+        """Distances between every query vector and every row of a block, one row per query
+
+        Euclidean and KL distances (relative entropy of query to indexed vector)
+        are computed with a single matrix product. For KL, indexed frequencies
+        are floored at 1e-6, so residues missing from a sequence give large but
+        finite distances."""
+
+        if metric == 'euclidean':
+            squares = np.sum(queries ** 2, axis=1)[:, np.newaxis] + \
+                np.sum(block ** 2, axis=1) - 2 * (queries @ block.T)
+            return np.sqrt(np.maximum(squares, 0))
+
+        if metric == 'kl':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                entropy = np.sum(np.where(queries > 0, queries * np.log(queries), 0), axis=1)
+            return entropy[:, np.newaxis] - queries @ np.log(np.maximum(block, 1e-6)).T
+
+        if metric == 'l1':
+            return np.stack([np.sum(np.abs(block - query), axis=1) for query in queries])
+
+        raise ValueError(f"Unknown metric {metric}, expected one of {CompositionIndex.METRICS}")
+
+    @staticmethod
+    def top_k(distances: np.ndarray, indices: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Select the k smallest distances in every row, with their indices, unordered"""
+
+        if distances.shape[1] <= k:
+            return indices, distances
+
+        part = np.argpartition(distances, k - 1, axis=1)[:, 0:k]
+        return np.take_along_axis(indices, part, axis=1), np.take_along_axis(distances, part, axis=1)
+
+    def search(self,
+               query_counts: np.ndarray,
+               k: int = 10,
+               metric: str = 'l1',
+               block_size: int = 65536,
+               workers: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k indexed sequences closest in composition to every query sequence
+
+        The index is scanned in blocks of rows, spread over worker threads;
+        each block keeps only its k nearest rows per query. Returns indices and
+        distances, one row per query, ordered from nearest."""
+
+        queries = CompositionIndex.normalize(np.asarray(query_counts))
+
+        def search_block(start: int) -> Tuple[np.ndarray, np.ndarray]:
+            block = np.asarray(self.frequencies[start:start + block_size])
+            distances = CompositionIndex.distances(block, queries, metric)
+            indices = np.broadcast_to(np.arange(start, start + len(block)), distances.shape)
+
+            return CompositionIndex.top_k(distances, indices, k)
+
+        starts = range(0, len(self), block_size)
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(search_block, starts))
+        else:
+            results = [search_block(start) for start in starts]
+
+        if not results:
+            return np.zeros((len(queries), 0), dtype=np.intp), np.zeros((len(queries), 0))
+
+        indices, distances = CompositionIndex.top_k(np.concatenate([r[1] for r in results], axis=1),
+            np.concatenate([r[0] for r in results], axis=1), k)
+
+        order = np.argsort(distances, axis=1, kind='stable')
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
@@ -12,8 +12,14 @@ import argparse
 import os
 import sys
 
+import numpy as np
+
 from cprofiler.aminoacid import AminoAcid
+from cprofiler.cache import CountCache
+from cprofiler.cluster import CompositionClustering
+from cprofiler.faidx import FastaIndex
 from cprofiler.fasta import Fasta
+from cprofiler.index import CompositionIndex
 from cprofiler.profile import CompositionProfiler
 
 
@@ -41,12 +47,14 @@ def init_validate_opts():
 
     # Mandatory argument
     discover_parser.add_argument('-Q', dest='query_file', required=True,
-        help='Query file in FastA format')
+        help='Query file in FastA format, possibly gzip, bz2, xz or zstd\n'
+             'compressed, or - for standard input')
 
     # Mutually exclusive group for background
     back_group_1 = discover_parser.add_mutually_exclusive_group()
     back_group_1.add_argument('-B', dest='background_file',
-        help='Background file in FastA format')
+        help='Background file in FastA format, possibly gzip, bz2, xz or\n'
+             'zstd compressed, or - for standard input')
 
     distribution_names = ""
     for key, value in CompositionProfiler.get_background_names():
@@ -62,12 +70,32 @@ def init_validate_opts():
     discover_parser.add_argument('-I', dest='iterations', type=int, default=10000,
         help='Number of bootstrap iterations. Defaults to 10,000.')
 
+    discover_parser.add_argument('-j', dest='workers', type=int, default=1,
+        help='Number of worker processes for sampling, and of threads for\n'
+             'counting FastA files. Defaults to 1.')
+
     discover_parser.add_argument('-A', dest='alpha_value', type=float, default=0.05,
         help='Significance value for statistical tests. Defaults to 0.05.')
 
     discover_parser.add_argument('-b', dest='bonferroni', action='store_true',
         help='Apply Bonferroni correction. Off by default.')
 
+    discover_parser.add_argument('-f', dest='fdr', action='store_true',
+        help='Control the false discovery rate at the significance value\n'
+             '(Benjamini-Hochberg). Off by default.')
+
+    discover_parser.add_argument('-a', dest='adaptive', action='store_true',
+        help='Stop sampling each test once its outcome is settled. Off by default.')
+
+    discover_parser.add_argument('-M', dest='method',
+        choices=list(['permutation', 'analytic']), default='permutation',
+        help='Significance from permutations or from an analytic approximation.\n'
+             'Defaults to permutation.')
+
+    discover_parser.add_argument('-d', dest='dedup', action='store_true',
+        help='Collapse identical sequence compositions into unique rows with\n'
+             'multiplicities, which are permuted as such. Off by default.')
+
     #
     # Plot fractional differences
     #
@@ -77,7 +105,8 @@ def init_validate_opts():
 
     # Mandatory arguments
     plot_parser.add_argument('-Q', dest='query_file', required=True,
-        help='Query file in FastA format')
+        help='Query file in FastA format, possibly gzip, bz2, xz or zstd\n'
+             'compressed, or - for standard input')
 
     plot_parser.add_argument('-O', dest='output_file', required=True,
         help='Output file')
@@ -85,7 +114,8 @@ def init_validate_opts():
     # Mutually exclusive group for background
     back_group_2 = plot_parser.add_mutually_exclusive_group()
     back_group_2.add_argument('-B', dest='background_file',
-        help='Background file in FastA format')
+        help='Background file in FastA format, possibly gzip, bz2, xz or\n'
+             'zstd compressed, or - for standard input')
     back_group_2.add_argument('-D', dest='distribution',
         choices=CompositionProfiler.list_backgrounds(), default='sprot',
         help='Preset background distribution. One of the following:\n\n'
@@ -96,6 +126,19 @@ def init_validate_opts():
     plot_parser.add_argument('-I', dest='iterations', type=int, default=10000,
         help='Number of bootstrap iterations. Defaults to 10,000.')
 
+    plot_parser.add_argument('-j', dest='workers', type=int, default=1,
+        help='Number of worker processes for sampling, and of threads for\n'
+             'counting FastA files. Defaults to 1.')
+
+    plot_parser.add_argument('-M', dest='method',
+        choices=list(['bootstrap', 'analytic']), default='bootstrap',
+        help='Error bars from bootstrap samples or from an analytic approximation.\n'
+             'Defaults to bootstrap.')
+
+    plot_parser.add_argument('-d', dest='dedup', action='store_true',
+        help='Collapse identical sequence compositions into unique rows with\n'
+             'multiplicities, which are resampled as such. Off by default.')
+
     # Amino acid ordering
     max_length = max(len(s) for s in AminoAcid.get_order_names())
     temp = ''
@@ -149,45 +192,516 @@ def init_validate_opts():
 
     # Mandatory argument
     relent_parser.add_argument('-Q', dest='query_file', required=True,
-        help='Query file in FastA format')
+        help='Query file in FastA format, possibly gzip, bz2, xz or zstd\n'
+             'compressed, or - for standard input')
 
     # Mutually exclusive group for background
     back_group_3 = relent_parser.add_mutually_exclusive_group()
     back_group_3.add_argument('-B', dest='background_file',
-        help='Background file in FastA format')
+        help='Background file in FastA format, possibly gzip, bz2, xz or\n'
+             'zstd compressed, or - for standard input')
     back_group_3.add_argument('-D', dest='distribution',
         choices=CompositionProfiler.list_backgrounds(), default='sprot',
         help='Preset background distribution. One of the following:\n\n'
              f"{distribution_names}\n"
              'Defaults to sprot.\n')
 
-    # Optional argument
+    # Optional arguments
     relent_parser.add_argument('-I', dest='iterations', type=int, default=10000,
         help='Number of bootstrap iterations. Defaults to 10,000.')
 
+    relent_parser.add_argument('-j', dest='workers', type=int, default=1,
+        help='Number of worker processes for sampling, and of threads for\n'
+             'counting FastA files. Defaults to 1.')
+
+    relent_parser.add_argument('-A', dest='alpha_value', type=float, default=0.05,
+        help='Significance value for adaptive sampling. Defaults to 0.05.')
+
+    relent_parser.add_argument('-a', dest='adaptive', action='store_true',
+        help='Stop sampling once the outcome is settled. Off by default.')
+
+    relent_parser.add_argument('-M', dest='method',
+        choices=list(['permutation', 'analytic']), default='permutation',
+        help='Significance from permutations or from an analytic approximation.\n'
+             'Defaults to permutation.')
+
+    relent_parser.add_argument('-d', dest='dedup', action='store_true',
+        help='Collapse identical sequence compositions into unique rows with\n'
+             'multiplicities, which are permuted as such. Off by default.')
+
+    #
+    # Discover, compute relative entropy and plot in one run
+    #
+    analyze_parser = subparsers.add_parser("analyze",
+        formatter_class=argparse.RawTextHelpFormatter,
+        help="Discover, compute relative entropy and plot from one sampling run")
+
+    # Mandatory arguments
+    analyze_parser.add_argument('-Q', dest='query_file', required=True,
+        help='Query file in FastA format, possibly gzip, bz2, xz or zstd\n'
+             'compressed, or - for standard input')
+
+    analyze_parser.add_argument('-O', dest='output_file', required=True,
+        help='Output file')
+
+    # Mutually exclusive group for background
+    back_group_4 = analyze_parser.add_mutually_exclusive_group()
+    back_group_4.add_argument('-B', dest='background_file',
+        help='Background file in FastA format, possibly gzip, bz2, xz or\n'
+             'zstd compressed, or - for standard input')
+    back_group_4.add_argument('-D', dest='distribution',
+        choices=CompositionProfiler.list_backgrounds(), default='sprot',
+        help='Preset background distribution. One of the following:\n\n'
+             f'{distribution_names}\n'
+             'Defaults to sprot.\n')
+
+    # Optional arguments
+    analyze_parser.add_argument('-I', dest='iterations', type=int, default=10000,
+        help='Number of bootstrap iterations. Defaults to 10,000.')
+
+    analyze_parser.add_argument('-j', dest='workers', type=int, default=1,
+        help='Number of worker processes for sampling, and of threads for\n'
+             'counting FastA files. Defaults to 1.')
+
+    analyze_parser.add_argument('-A', dest='alpha_value', type=float, default=0.05,
+        help='Significance value for statistical tests. Defaults to 0.05.')
+
+    analyze_parser.add_argument('-b', dest='bonferroni', action='store_true',
+        help='Apply Bonferroni correction. Off by default.')
+
+    analyze_parser.add_argument('-M', dest='method',
+        choices=list(['permutation', 'analytic']), default='permutation',
+        help='Significance and error bars from sampling or from an analytic\n'
+             'approximation. Defaults to permutation.')
+
+    temp = ''
+    for key, value in AminoAcid.get_order_names():
+        temp += f"{key:{max_length}} {value}\n"
+
+    analyze_parser.add_argument('-X', dest='aa_order',
+        choices=AminoAcid.list_orders(), default='diff',
+        help='Amino acid ordering. Sorts residues in the increasing order of one of the\n'
+             'physicochemical or structural properties:\n\n'
+             f"{temp}\n"
+             'Defaults to ordering By observed differences.'
+            )
+
+    analyze_parser.add_argument('-Y', dest='ylab', help='Y-axis label')
+
+    temp = ''
+    for key, value in AminoAcid.get_color_scheme_names():
+        temp += f"{key:{max_length}} {value}\n"
+
+    analyze_parser.add_argument('-C', dest='color_scheme',
+        choices=AminoAcid.list_color_schemes(), default='mono',
+        help='Color scheme. One of the following:\n\n'
+             f"{temp}\n"
+             'Defaults to Monochromatic.\n')
+
+    analyze_parser.add_argument('-F', dest='output_format',
+        choices=list(['png', 'pdf', 'eps', 'txt']), default='png',
+        help='Output format. Defaults to png.')
+
+    analyze_parser.add_argument('-W', dest='image_width', type=float, default=5,
+        help='Width of output image. Defaults to 5.')
+
+    analyze_parser.add_argument('-H', dest='image_height', type=float, default=3.5,
+        help='Height of output image. Defaults to 3.5.')
+
+    analyze_parser.add_argument('-U', dest='image_size_units',
+        choices=list(['inch', 'cm', 'pixel']), default='inch',
+        help='Image size units. Defaults to inch.')
+
+    analyze_parser.add_argument('-R', dest='resolution', type=float, default=300,
+        help='Bitmap resolution in dpi. Defaults to 300.')
+
+    #
+    # Score sequences with query to background log-odds
+    #
+    score_parser = subparsers.add_parser("score",
+        formatter_class=argparse.RawTextHelpFormatter,
+        help="Score sequences by query to background log-odds")
+
+    # Mandatory arguments
+    score_parser.add_argument('-Q', dest='query_file', required=True,
+        help='Query file in FastA format, possibly gzip, bz2, xz or zstd\n'
+             'compressed, or - for standard input')
+
+    score_parser.add_argument('-S', dest='score_file', required=True,
+        help='File in FastA format with sequences to score')
+
+    # Mutually exclusive group for background
+    back_group_5 = score_parser.add_mutually_exclusive_group()
+    back_group_5.add_argument('-B', dest='background_file',
+        help='Background file in FastA format, possibly gzip, bz2, xz or\n'
+             'zstd compressed, or - for standard input')
+    back_group_5.add_argument('-D', dest='distribution',
+        choices=CompositionProfiler.list_backgrounds(), default='sprot',
+        help='Preset background distribution. One of the following:\n\n'
+             f'{distribution_names}\n'
+             'Defaults to sprot.\n')
+
+    # Optional arguments
+    score_parser.add_argument('-O', dest='output_file',
+        help='Output file. Defaults to standard output.')
+
+    score_parser.add_argument('-j', dest='workers', type=int, default=1,
+        help='Number of threads for counting FastA files. Defaults to 1.')
+
+    #
+    # Relative entropy between every pair of sets
+    #
+    matrix_parser = subparsers.add_parser("relent-matrix",
+        formatter_class=argparse.RawTextHelpFormatter,
+        help="Compute relative entropy between every pair of sets")
+
+    # Mandatory arguments
+    matrix_parser.add_argument('-Q', dest='query_files', required=True, nargs='+',
+        help='Files in FastA format')
+
+    matrix_parser.add_argument('-O', dest='output_file', required=True,
+        help='Output file for the symmetrized relative entropy matrix.\n'
+             'Written as .npy if the name ends in .npy, else as tab-separated values.')
+
+    # Optional arguments
+    matrix_parser.add_argument('-I', dest='iterations', type=int, default=0,
+        help='Number of permutation iterations for p-values.\n'
+             'Defaults to 0, no p-values.')
+
+    matrix_parser.add_argument('-P', dest='pvalue_file',
+        help='Output file for the matrix of p-values, in the same format.')
+
+    matrix_parser.add_argument('-j', dest='workers', type=int, default=1,
+        help='Number of worker processes for sampling, and of threads for\n'
+             'counting FastA files. Defaults to 1.')
+
+    #
+    # Build a composition index
+    #
+    index_parser = subparsers.add_parser("index",
+        formatter_class=argparse.RawTextHelpFormatter,
+        help="Build a composition index of a sequence database")
+
+    # Mandatory arguments
+    index_parser.add_argument('-S', dest='sequence_file', required=True,
+        help='Database file in FastA format')
+
+    index_parser.add_argument('-O', dest='index_dir', required=True,
+        help='Output directory for the index')
+
+    #
+    # Search a composition index
+    #
+    search_parser = subparsers.add_parser("search",
+        formatter_class=argparse.RawTextHelpFormatter,
+        help="Find database sequences closest in composition to query sequences")
+
+    # Mandatory arguments
+    search_parser.add_argument('-Q', dest='query_file', required=True,
+        help='Query file in FastA format')
+
+    search_parser.add_argument('-N', dest='index_dir', required=True,
+        help='Index directory, built with cprof index')
+
+    # Optional arguments
+    search_parser.add_argument('-K', dest='neighbors', type=int, default=10,
+        help='Number of nearest sequences reported per query. Defaults to 10.')
+
+    search_parser.add_argument('-M', dest='metric',
+        choices=CompositionIndex.METRICS, default='l1',
+        help='Distance between composition vectors. Defaults to l1.')
+
+    search_parser.add_argument('-j', dest='workers', type=int, default=1,
+        help='Number of threads for searching. Defaults to 1.')
+
+    search_parser.add_argument('-O', dest='output_file',
+        help='Output file. Defaults to standard output.')
+
+    #
+    # Index a FastA file and fetch records by header
+    #
+    faidx_parser = subparsers.add_parser("faidx",
+        formatter_class=argparse.RawTextHelpFormatter,
+        help="Index the records of a FastA file and fetch records by header")
+
+    # Mandatory arguments
+    faidx_parser.add_argument('-S', dest='sequence_file', required=True,
+        help='FastA file to index')
+
+    # Optional arguments
+    faidx_parser.add_argument('-H', dest='headers', nargs='+', default=[],
+        help='Headers of records to fetch. Without them the index is only\n'
+             'built, or rebuilt if the FastA file changed.')
+
+    faidx_parser.add_argument('-O', dest='output_file',
+        help='Output file for fetched records, compressed if it ends in .gz,\n'
+             '.bz2, .xz or .zst. Defaults to standard output.')
+
+    #
+    # Cluster sequences by composition
+    #
+    cluster_parser = subparsers.add_parser("cluster",
+        formatter_class=argparse.RawTextHelpFormatter,
+        help="Cluster sequences by composition")
+
+    # Mandatory arguments
+    cluster_parser.add_argument('-S', dest='sequence_file', required=True,
+        help='File in FastA format with sequences to cluster')
+
+    cluster_parser.add_argument('-K', dest='clusters', type=int, required=True,
+        help='Number of clusters')
+
+    cluster_parser.add_argument('-O', dest='output_file', required=True,
+        help='Output file for cluster assignments')
+
+    # Optional arguments
+    cluster_parser.add_argument('-E', dest='epochs', type=int, default=1,
+        help='Number of passes over the sequences while clustering. Defaults to 1.')
+
+    cluster_parser.add_argument('-P', dest='profile_file',
+        help='Output file for discover results of every cluster against the background.\n'
+             'Off by default.')
+
+    # Mutually exclusive group for background
+    back_group_6 = cluster_parser.add_mutually_exclusive_group()
+    back_group_6.add_argument('-B', dest='background_file',
+        help='Background file in FastA format')
+    back_group_6.add_argument('-D', dest='distribution',
+        choices=CompositionProfiler.list_backgrounds(), default='sprot',
+        help='Preset background distribution. One of the following:\n\n'
+             f'{distribution_names}\n'
+             'Defaults to sprot.\n')
+
+    cluster_parser.add_argument('-I', dest='iterations', type=int, default=10000,
+        help='Number of bootstrap iterations. Defaults to 10,000.')
+
+    cluster_parser.add_argument('-j', dest='workers', type=int, default=1,
+        help='Number of worker processes for sampling, and of threads for\n'
+             'counting FastA files. Defaults to 1.')
+
+    cluster_parser.add_argument('-A', dest='alpha_value', type=float, default=0.05,
+        help='Significance value for statistical tests. Defaults to 0.05.')
+
+    cluster_parser.add_argument('-M', dest='method',
+        choices=list(['permutation', 'analytic']), default='permutation',
+        help='Significance from permutations or from an analytic approximation.\n'
+             'Defaults to permutation.')
+
+    #
+    # Composition in sliding windows along sequences
+    #
+    window_parser = subparsers.add_parser("window",
+        formatter_class=argparse.RawTextHelpFormatter,
+        help="Compute compositions in sliding windows along sequences")
+
+    # Mandatory arguments
+    window_parser.add_argument('-S', dest='sequence_file', required=True,
+        help='File in FastA format')
+
+    window_parser.add_argument('-W', dest='width', type=int, required=True,
+        help='Window width')
+
+    # Optional arguments
+    window_parser.add_argument('-G', dest='groups', nargs='+', default=[],
+        choices=AminoAcid.list_groups(), metavar='GROUP',
+        help='Amino acid groups whose fractions are reported. One or more of:\n\n'
+             f"{' '.join(AminoAcid.list_groups())}\n")
+
+    window_parser.add_argument('-P', dest='properties', nargs='+', default=[],
+        choices=AminoAcid.list_properties(), metavar='PROPERTY',
+        help='Amino acid properties whose averages are reported. One or more of:\n\n'
+             f"{' '.join(AminoAcid.list_properties())}\n\n"
+             'Without -G and -P, fractions of all amino acids are reported.')
+
+    window_parser.add_argument('-O', dest='output_file',
+        help='Output file. Defaults to standard output.')
+
+    #
+    # Discover significant k-mer fractional differences
+    #
+    kmer_parser = subparsers.add_parser("kmer",
+        formatter_class=argparse.RawTextHelpFormatter,
+        help="Discover significant fractional differences of k-mers")
+
+    # Mandatory argument
+    kmer_parser.add_argument('-Q', dest='query_file', required=True,
+        help='Query file in FastA format, possibly gzip, bz2, xz or zstd\n'
+             'compressed, or - for standard input')
+
+    # Mutually exclusive group for background
+    back_group_7 = kmer_parser.add_mutually_exclusive_group()
+    back_group_7.add_argument('-B', dest='background_file',
+        help='Background file in FastA format, possibly gzip, bz2, xz or\n'
+             'zstd compressed, or - for standard input')
+    back_group_7.add_argument('-D', dest='distribution',
+        choices=CompositionProfiler.list_backgrounds(), default='sprot',
+        help='Preset background distribution. One of the following:\n\n'
+             f'{distribution_names}\n'
+             'Defaults to sprot.\n')
+
+    # Optional arguments
+    kmer_parser.add_argument('-K', dest='k', type=int, default=2,
+        help='Length of k-mers. Defaults to 2, dipeptides.')
+
+    reduced_names = ''
+    for key, value in AminoAcid.get_reduced_alphabet_names():
+        reduced_names += f"{key:{12}} {value}\n"
+
+    kmer_parser.add_argument('-R', dest='reduced_alphabet',
+        choices=AminoAcid.list_reduced_alphabets(),
+        help='Reduced alphabet, whose groups of amino acids make up k-mers.\n'
+             'One of the following:\n\n'
+             f"{reduced_names}\n"
+             'Defaults to the 20 amino acids.\n')
+
+    kmer_parser.add_argument('-I', dest='iterations', type=int, default=10000,
+        help='Number of bootstrap iterations. Defaults to 10,000.')
+
+    kmer_parser.add_argument('-j', dest='workers', type=int, default=1,
+        help='Number of worker processes for sampling. Defaults to 1.')
+
+    kmer_parser.add_argument('-A', dest='alpha_value', type=float, default=0.05,
+        help='Significance value for statistical tests. Defaults to 0.05.')
+
+    kmer_parser.add_argument('-b', dest='bonferroni', action='store_true',
+        help='Apply Bonferroni correction. Off by default.')
+
+    kmer_parser.add_argument('-f', dest='fdr', action='store_true',
+        help='Control the false discovery rate at the significance value\n'
+             '(Benjamini-Hochberg). Off by default.')
+
+    kmer_parser.add_argument('-a', dest='adaptive', action='store_true',
+        help='Stop sampling each test once its outcome is settled. Off by default.')
+
+    kmer_parser.add_argument('-M', dest='method',
+        choices=list(['permutation', 'analytic']), default='permutation',
+        help='Significance from permutations or from an analytic approximation.\n'
+             'Defaults to permutation.')
+
+    kmer_parser.add_argument('-O', dest='output_file',
+        help='Output file for the results table. Defaults to standard output.')
+
     args = parser.parse_args()
     opts = vars(args)
 
-    # Query sample file
-    if not os.path.exists(opts['query_file']):
+    if opts['command'] == 'kmer' and int(opts['k']) < 1:
+        error(opts['command'], "Length of k-mers has to be a positive integer.")
+
+    if opts['command'] == 'window':
+        if not os.path.exists(opts['sequence_file']):
+            error(opts['command'], f"Could not open FastA file {opts['sequence_file']}.")
+
+        if int(opts['width']) < 1:
+            error(opts['command'], "Window width has to be a positive integer.")
+
+        return opts
+
+    if opts['command'] == 'cluster':
+        if not os.path.exists(opts['sequence_file']):
+            error(opts['command'], f"Could not open FastA file {opts['sequence_file']}.")
+
+        if int(opts['clusters']) < 1:
+            error(opts['command'], "Number of clusters has to be a positive integer.")
+
+        if int(opts['epochs']) < 1:
+            error(opts['command'], "Number of passes has to be a positive integer.")
+
+        if opts['background_file'] is not None and not os.path.exists(opts['background_file']):
+            error(opts['command'], f"Could not open background FastA file {opts['background_file']}.")
+
+        if int(opts['iterations']) < 1:
+            error(opts['command'], "Number of bootstrap iterations has to be a positive integer.")
+
+        if int(opts['workers']) < 1:
+            error(opts['command'], "Number of worker processes has to be a positive integer.")
+
+        return opts
+
+    if opts['command'] == 'index':
+        if not os.path.exists(opts['sequence_file']):
+            error(opts['command'], f"Could not open FastA file {opts['sequence_file']}.")
+
+        return opts
+
+    if opts['command'] == 'faidx':
+        if not os.path.exists(opts['sequence_file']):
+            error(opts['command'], f"Could not open FastA file {opts['sequence_file']}.")
+
+        if Fasta.is_compressed(opts['sequence_file']):
+            error(opts['command'], f"Compressed FastA file {opts['sequence_file']} cannot be indexed.")
+
+        return opts
+
+    if opts['command'] == 'search':
+        if not os.path.exists(opts['query_file']):
+            error(opts['command'], f"Could not open query FastA file {opts['query_file']}.")
+
+        if not os.path.exists(os.path.join(opts['index_dir'], 'frequencies.npy')):
+            error(opts['command'], f"Could not open index {opts['index_dir']}.")
+
+        if int(opts['neighbors']) < 1:
+            error(opts['command'], "Number of nearest sequences has to be a positive integer.")
+
+        if int(opts['workers']) < 1:
+            error(opts['command'], "Number of threads has to be a positive integer.")
+
+        return opts
+
+    if opts['command'] == 'relent-matrix':
+        for filename in opts['query_files']:
+            if not os.path.exists(filename):
+                error(opts['command'], f"Could not open FastA file {filename}.")
+
+        if len(opts['query_files']) < 2:
+            error(opts['command'], "At least two FastA files are needed.")
+
+        if int(opts['iterations']) < 0:
+            error(opts['command'], "Number of permutation iterations cannot be negative.")
+
+        if int(opts['iterations']) > 0 and opts['pvalue_file'] is None:
+            error(opts['command'], "Option -P is needed for p-values.")
+
+        if int(opts['workers']) < 1:
+            error(opts['command'], "Number of worker processes has to be a positive integer.")
+
+        return opts
+
+    # Query sample file, '-' for standard input
+    if opts['query_file'] != '-' and not os.path.exists(opts['query_file']):
         error(opts['command'], f"Could not open query FastA file {opts['query_file']}.")
 
     if opts['background_file'] is None and opts['distribution'] is None:
         error(opts['command'], 'Either -B or -D must be selected.')
 
-    # Background sample file
-    if opts['background_file'] is not None and not os.path.exists(opts['background_file']):
+    # Background sample file, '-' for standard input
+    if opts['background_file'] not in (None, '-') and not os.path.exists(opts['background_file']):
         error(opts['command'], f"Could not open background FastA file {opts['background_file']}.")
 
+    if opts['query_file'] == '-' and opts['background_file'] == '-':
+        error(opts['command'], 'Only one of -Q and -B can read standard input.')
+
     if opts['distribution'] is not None and \
         not os.path.exists(CompositionProfiler.get_background_file(opts['distribution'])):
         error(opts['command'], f"Could not open FastA file for distribution {opts['distribution']}.")
 
+    if opts['command'] == 'score':
+        if not os.path.exists(opts['score_file']):
+            error(opts['command'], f"Could not open FastA file {opts['score_file']}.")
+
+        if int(opts['workers']) < 1:
+            error(opts['command'], "Number of worker processes has to be a positive integer.")
+
+        return opts
+
     # Number of bootstrap iterations
     if int(opts['iterations']) < 1:
         error(opts['command'], "Number of bootstrap iterations has to be a positive integer.")
 
-    if opts['command'] == 'plot':
+    # Number of worker processes
+    if int(opts['workers']) < 1:
+        error(opts['command'], "Number of worker processes has to be a positive integer.")
+
+    if opts['command'] in ('plot', 'analyze'):
         if opts['image_size_units'] == "cm":
             opts['image_height'] /= 2.54
             opts['image_width'] /= 2.54
@@ -203,20 +717,160 @@ def main():
 
     opts = init_validate_opts()
 
-    # Specify alphabet to produce data in the order in which it will be consumed
+    if opts['command'] == 'window':
+        alphabet = AminoAcid.AA_1_LETTER
+        weights = Fasta.window_weights(alphabet, opts['groups'], opts['properties'])
+        columns = opts['groups'] + opts['properties'] or list(alphabet)
+
+        out = sys.stdout if opts['output_file'] is None else open(opts['output_file'], 'w')
+        out.write('\t'.join(['header', 'start'] + columns) + '\n')
+
+        with Fasta.open(opts['sequence_file']) as fin:
+            for seq, averages in Fasta.iter_windows(Fasta.iter_stream(fin), alphabet, opts['width'], weights):
+                # One formatting call per sequence, with the header (% escaped) in the row format
+                row = seq.header.replace('%', '%%') + '\t%d' + '\t%.3f' * len(columns) + '\n'
+                values = np.column_stack((np.arange(1, len(averages) + 1), averages))
+                out.write(row * len(averages) % tuple(values.ravel().tolist()))
+
+        if out is not sys.stdout:
+            out.close()
+
+        return
+
+    if opts['command'] == 'cluster':
+        try:
+            centroids = CompositionClustering.fit(opts['sequence_file'], opts['clusters'], opts['epochs'])
+        except ValueError as e:
+            error(opts['command'], str(e))
+
+        labels = []
+        with open(opts['output_file'], 'w') as out:
+            for headers, batch_labels, distances in CompositionClustering.predict(opts['sequence_file'],
+                                                                                  centroids):
+                out.writelines(f'{headers[i]}\t{batch_labels[i]}\t{distances[i]:.4f}\n'
+                               for i in range(len(headers)))
+                labels.append(batch_labels)
+
+        if opts['profile_file'] is not None:
+            labels = np.concatenate(labels)
+            counts = CountCache.count_file(opts['sequence_file'], workers=opts['workers'])
+
+            if opts['background_file'] is not None:
+                background_counts = CountCache.count_file(opts['background_file'], workers=opts['workers'])
+            else:
+                background_counts = CompositionProfiler.get_background_counts(opts['distribution'])
+
+            clusters = [c for c in range(opts['clusters']) if np.any(labels == c)]
+
+            df = CompositionProfiler.discover_many([counts[labels == c] for c in clusters],
+                background_counts,
+                alphabet = AminoAcid.AA_1_LETTER,
+                groups = AminoAcid.get_groups(),
+                group_names = AminoAcid.get_group_names(),
+                iterations = opts['iterations'],
+                alpha_value = opts['alpha_value'],
+                workers = opts['workers'],
+                method = opts['method'],
+                query_names = clusters)
+            df.to_csv(opts['profile_file'], sep='\t', index=False)
+
+        return
+
+    if opts['command'] == 'index':
+        CompositionIndex.build(opts['sequence_file'], opts['index_dir'])
+        return
+
+    if opts['command'] == 'faidx':
+        index = FastaIndex(opts['sequence_file'])
+
+        try:
+            records = [index.fetch(header) for header in opts['headers']]
+        except KeyError as e:
+            error(opts['command'], f"No record with header {e} in {opts['sequence_file']}.")
+
+        Fasta.write(records, '-' if opts['output_file'] is None else opts['output_file'])
+        return
+
+    if opts['command'] == 'search':
+        index = CompositionIndex(opts['index_dir'])
+        queries = Fasta.read(opts['query_file'])
+
+        indices, distances = index.search(Fasta.count_chars(queries, index.alphabet),
+            k = opts['neighbors'],
+            metric = opts['metric'],
+            workers = opts['workers'])
+
+        out = sys.stdout if opts['output_file'] is None else open(opts['output_file'], 'w')
+        for i, seq in enumerate(queries):
+            for rank, (j, distance) in enumerate(zip(indices[i], distances[i]), 1):
+                out.write(f'{seq.header}\t{rank}\t{index.get_header(j)}\t{distance:.4f}\n')
+
+        if out is not sys.stdout:
+            out.close()
+
+        return
+
+    if opts['command'] == 'relent-matrix':
+        counts = [CountCache.count_file(filename, workers=opts['workers']) for filename in opts['query_files']]
+        names = [os.path.basename(filename) for filename in opts['query_files']]
+
+        relent, pvalues = CompositionProfiler.relent_matrix(counts,
+            iterations = opts['iterations'],
+            workers = opts['workers'])
+
+        CompositionProfiler.write_matrix(relent, names, opts['output_file'])
+        if pvalues is not None:
+            CompositionProfiler.write_matrix(pvalues, names, opts['pvalue_file'])
+
+        return
+
+    if opts['command'] == 'kmer':
+        if opts['reduced_alphabet'] is not None:
+            kmer_alphabet = AminoAcid.get_reduced_alphabet(opts['reduced_alphabet'])
+        else:
+            kmer_alphabet = AminoAcid.AA_1_LETTER
+
+        if opts['background_file'] is not None:
+            background_file = opts['background_file']
+        else:
+            background_file = CompositionProfiler.get_background_file(opts['distribution'])
+
+        names = Fasta.kmer_names(kmer_alphabet, opts['k'])
+        if opts['bonferroni']:
+            opts['alpha_value'] = opts['alpha_value'] / len(names)
+
+        df = CompositionProfiler.discover(Fasta.count_kmers_file(opts['query_file'], kmer_alphabet, opts['k']),
+            Fasta.count_kmers_file(background_file, kmer_alphabet, opts['k']),
+            alphabet = names,
+            groups = {},
+            group_names = {},
+            iterations = opts['iterations'],
+            alpha_value = opts['alpha_value'],
+            workers = opts['workers'],
+            adaptive = opts['adaptive'],
+            method = opts['method'],
+            fdr = opts['fdr'])
+
+        df.to_csv(sys.stdout if opts['output_file'] is None else opts['output_file'], sep='\t', index=False)
+
+        return
+
+    # Counts are produced and cached in canonical order, and only permuted to
+    # the order in which they will be consumed
     if 'aa_order' not in opts or opts['aa_order'] not in AminoAcid.list_orders():
         alphabet = AminoAcid.get_order('alpha')
     else:
         alphabet = AminoAcid.get_order(opts['aa_order'])
 
-    query = Fasta.read(opts['query_file'])
-    query_counts = Fasta.count_chars(query, alphabet)
+    query_counts = CountCache.count_file(opts['query_file'], workers=opts['workers'])
 
     if opts['background_file'] is not None:
-        background = Fasta.read(opts['background_file'])
+        background_counts = CountCache.count_file(opts['background_file'], workers=opts['workers'])
     elif opts['distribution'] is not None:
-        background = Fasta.read(CompositionProfiler.get_background_file(opts['distribution']))
-    background_counts = Fasta.count_chars(background, alphabet)
+        background_counts = CompositionProfiler.get_background_counts(opts['distribution'])
+
+    query_counts = Fasta.permute_columns(query_counts, AminoAcid.AA_1_LETTER, alphabet)
+    background_counts = Fasta.permute_columns(background_counts, AminoAcid.AA_1_LETTER, alphabet)
 
     if opts['command'] == 'discover':
         if opts['bonferroni']:
@@ -228,7 +882,12 @@ def main():
             groups = AminoAcid.get_groups(),
             group_names = AminoAcid.get_group_names(),
             iterations = opts['iterations'],
-            alpha_value = opts['alpha_value'])
+            alpha_value = opts['alpha_value'],
+            workers = opts['workers'],
+            adaptive = opts['adaptive'],
+            method = opts['method'],
+            fdr = opts['fdr'],
+            dedup = opts['dedup'])
         print(df)
 
     if opts['command'] == 'plot':
@@ -247,19 +906,81 @@ def main():
             image_height = opts['image_height'],
             image_width = opts['image_width'],
             resolution = opts['resolution'],
-            iterations = opts['iterations'])
+            iterations = opts['iterations'],
+            workers = opts['workers'],
+            method = opts['method'],
+            dedup = opts['dedup'])
 
     if opts['command'] == 'relent':
-        relent, pvalue = CompositionProfiler.relent(query_counts,
+        result = CompositionProfiler.relent(query_counts,
+            background_counts,
+            opts['iterations'],
+            workers = opts['workers'],
+            adaptive = opts['adaptive'],
+            alpha_value = opts['alpha_value'],
+            method = opts['method'],
+            dedup = opts['dedup'])
+
+        relent, pvalue = result[0:2]
+        iterations = result[2] if len(result) > 2 else opts['iterations']
+
+        print(f"Relative entropy = {relent:.3f}")
+        if pvalue > 0 or opts['method'] == 'analytic':
+            print(f"P-value = {pvalue}")
+        else:
+            print(f"P-value < {1 / iterations}")
+        if len(result) > 2:
+            print(f"Iterations = {iterations}")
+
+    if opts['command'] == 'score':
+        weights = CompositionProfiler.get_weights(query_counts, background_counts)
+
+        out = sys.stdout if opts['output_file'] is None else open(opts['output_file'], 'w')
+        with Fasta.open(opts['score_file']) as fin:
+            for headers, lengths, scores in CompositionProfiler.score_stream(fin, weights, alphabet):
+                out.writelines(f'{headers[i]}\t{lengths[i]}\t{scores[i]:.3f}\n'
+                               for i in range(len(headers)))
+
+        if out is not sys.stdout:
+            out.close()
+
+    if opts['command'] == 'analyze':
+        if opts['bonferroni']:
+            opts['alpha_value'] = opts['alpha_value'] / (len(alphabet) + len(AminoAcid.get_groups()))
+
+        df, relent, pvalue, errors = CompositionProfiler.analyze(query_counts,
             background_counts,
-            opts['iterations'])
+            alphabet = alphabet,
+            groups = AminoAcid.get_groups(),
+            group_names = AminoAcid.get_group_names(),
+            iterations = opts['iterations'],
+            alpha_value = opts['alpha_value'],
+            workers = opts['workers'],
+            method = opts['method'])
+        print(df)
 
         print(f"Relative entropy = {relent:.3f}")
-        if pvalue > 0:
+        if pvalue > 0 or opts['method'] == 'analytic':
             print(f"P-value = {pvalue}")
         else:
             print(f"P-value < {1 / opts['iterations']}")
 
+        colors = []
+        for ch in alphabet:
+            colors.append(AminoAcid.get_color(opts['color_scheme'], ch))
+
+        CompositionProfiler.write_profile(list(alphabet),
+            df.effect.values[0:len(alphabet)],
+            errors,
+            colors = colors,
+            reorder_by_value = (opts['aa_order'] == 'diff'),
+            output_format = opts['output_format'],
+            output_file = opts['output_file'],
+            ylab = opts['ylab'],
+            image_height = opts['image_height'],
+            image_width = opts['image_width'],
+            resolution = opts['resolution'])
+
 
 if __name__ == "__main__":
     main()
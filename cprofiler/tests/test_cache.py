@@ -0,0 +1,103 @@
+import gzip
+
+import numpy as np
+
+from cprofiler.aminoacid import AminoAcid
+from cprofiler.cache import CountCache
+from cprofiler.fasta import Fasta
+
+
+def test_count_file_cache(tmp_path, monkeypatch):
+    """Test that CountCache.count_file() stores, reuses and invalidates counts"""
+
+    monkeypatch.setenv('CPROFILER_CACHE_DIR', str(tmp_path / 'cache'))
+
+    fasta_file = tmp_path / 'sample.fa.gz'
+    fasta_file.write_bytes(gzip.compress(b">a\nACDA\n>b\nWY\n"))
+
+    t = CountCache.count_file(fasta_file, AminoAcid.AA_1_LETTER)
+    assert (t == Fasta.count_file(fasta_file, AminoAcid.AA_1_LETTER)).all()
+    assert len(list((tmp_path / 'cache').glob('*.npy'))) == 1
+
+    cached = CountCache.count_file(fasta_file, AminoAcid.AA_1_LETTER)
+    assert isinstance(cached, np.memmap)
+    assert (cached == t).all()
+
+    # Any reordering is served from the same canonical entry
+    alphabet = AminoAcid.get_order('flexibility_vihinen')
+    assert (CountCache.count_file(fasta_file, alphabet) == Fasta.count_file(fasta_file, alphabet)).all()
+    assert len(list((tmp_path / 'cache').glob('*.npy'))) == 1
+
+    # Changed contents get a new entry and the stale one is removed
+    fasta_file.write_bytes(gzip.compress(b">a\nCCCC\n"))
+
+    t = CountCache.count_file(fasta_file, AminoAcid.AA_1_LETTER)
+    assert t.shape == (1, 20)
+    assert t[0, 1] == 4
+    assert len(list((tmp_path / 'cache').glob('*.npy'))) == 1
+
+
+def test_cache_entries(tmp_path, monkeypatch):
+    """Test that counting a file only removes stale entries of that same file"""
+
+    monkeypatch.setenv('CPROFILER_CACHE_DIR', str(tmp_path / 'cache'))
+
+    for name in ('a/query.fa', 'b/query.fa', 'a/query.fa.gz'):
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_bytes(gzip.compress(f">{name}\nACDA\n".encode('utf-8')))
+        CountCache.count_file(tmp_path / name)
+
+    assert len(list((tmp_path / 'cache').glob('*.npy'))) == 3
+
+    (tmp_path / 'a/query.fa').write_bytes(gzip.compress(b">a\nWY\n"))
+    assert CountCache.count_file(tmp_path / 'a/query.fa')[0, -1] == 1
+
+    entries = list((tmp_path / 'cache').glob('*.npy'))
+    assert len(entries) == 3
+    assert CountCache.get_cache_file(tmp_path / 'a/query.fa') in entries
+
+
+def test_count_file_index(tmp_path, monkeypatch):
+    """Test that plain files are counted through their index, without hashing their contents"""
+
+    monkeypatch.setenv('CPROFILER_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(CountCache, 'file_digest', None)
+
+    fasta_file = tmp_path / 'sample.fa'
+    fasta_file.write_text(">a\nACDA\n>b\nWY\n")
+
+    t = CountCache.count_file(fasta_file, AminoAcid.AA_1_LETTER, workers=2)
+    assert (t == Fasta.count_file(fasta_file, AminoAcid.AA_1_LETTER)).all()
+    assert len(list((tmp_path / 'cache').glob('sample.fa.*.cfai.npy'))) == 1
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['cache', 'sample.fa']
+
+    cached = CountCache.count_file(fasta_file, AminoAcid.AA_1_LETTER)
+    assert isinstance(cached, np.memmap)
+    assert (cached == t).all()
+
+    alphabet = AminoAcid.get_order('flexibility_vihinen')
+    assert (CountCache.count_file(fasta_file, alphabet) == Fasta.count_file(fasta_file, alphabet)).all()
+
+    # Rebuilding the index for changed contents drops the stored counts
+    fasta_file.write_text(">a\nCCCC\n")
+
+    t = CountCache.count_file(fasta_file, AminoAcid.AA_1_LETTER)
+    assert t.shape == (1, 20)
+    assert t[0, 1] == 4
+
+
+def test_count_file_unwritable(tmp_path, monkeypatch):
+    """Test that an unwritable cache directory only disables caching"""
+
+    (tmp_path / 'file').write_text('')
+    monkeypatch.setenv('CPROFILER_CACHE_DIR', str(tmp_path / 'file' / 'cache'))
+
+    fasta_file = tmp_path / 'sample.fa'
+    fasta_file.write_text(">a\nACDA\n>b\nWY\n")
+
+    expected = Fasta.count_file(fasta_file, AminoAcid.AA_1_LETTER)
+    assert (CountCache.count_file(fasta_file, workers=2) == expected).all()
+
+    gzip_file = tmp_path / 'sample.fa.gz'
+    gzip_file.write_bytes(gzip.compress(fasta_file.read_bytes()))
+    assert (CountCache.count_file(gzip_file) == expected).all()
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from cprofiler.cluster import CompositionClustering
+
+
+def test_cluster(tmp_path):
+    """Test that sequences of two distinct compositions fall into separate clusters"""
+
+    fasta_file = tmp_path / 'sample.fa'
+    fasta_file.write_text(''.join(f">a{i}\nAAAC{'A' * i}\n>b{i}\nDEDE{'E' * i}\n" for i in range(20)))
+
+    centroids = CompositionClustering.fit(fasta_file, 2, epochs=3, alphabet='ACDE', batch_size=8)
+    assert centroids.shape == (2, 4)
+
+    headers, labels, distances = zip(*CompositionClustering.predict(fasta_file, centroids,
+                                                                    alphabet='ACDE', batch_size=8))
+    headers = sum(headers, [])
+    labels = np.concatenate(labels)
+
+    assert len(headers) == 40
+    assert len(set(labels[0::2])) == 1 and len(set(labels[1::2])) == 1
+    assert labels[0] != labels[1]
+    assert (np.concatenate(distances) < 0.5).all()
+
+    with pytest.raises(ValueError):
+        CompositionClustering.fit(fasta_file, 50, alphabet='ACDE')
+
+    with pytest.raises(ValueError):
+        CompositionClustering.fit(fasta_file, 50, epochs=2, alphabet='ACDE')
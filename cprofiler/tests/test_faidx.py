@@ -0,0 +1,33 @@
+from cprofiler.aminoacid import AminoAcid
+from cprofiler.faidx import FastaIndex
+from cprofiler.fasta import Fasta, Sequence
+
+
+def test_fasta_index(tmp_path):
+    """Test that an index counts and fetches records like parsing the file does"""
+
+    fasta_file = tmp_path / 'sample.fa'
+    fasta_file.write_bytes(b">a\tb c\r\nACDA\r\nWY\n\n> empty\n>c\nyyCC\nK")
+
+    index = FastaIndex(fasta_file)
+    sequences = Fasta.read(fasta_file)
+    alphabet = AminoAcid.AA_1_LETTER
+
+    assert (tmp_path / 'sample.fa.cfai').exists()
+    assert len(index) == 3
+    assert list(index) == list(sequences)
+    assert list(index.lengths) == [6, 0, 5]
+    assert (index.count_chars(alphabet) == Fasta.count_chars(sequences, alphabet)).all()
+    assert (index.count_chars(alphabet, 1, 3, batch_bytes=1) == Fasta.count_chars(sequences[1:], alphabet)).all()
+    assert index.fetch('c') == Sequence('c', 'yyCCK')
+    assert [stop for _, stop in index.split(2)][-1] == 3
+
+    # The stored index is reused, and rebuilt once the file changes
+    assert FastaIndex(fasta_file).headers == index.headers
+
+    fasta_file.write_text(">d\nMM\n")
+    assert FastaIndex(fasta_file).headers == ['d']
+
+    # Indented headers and bare carriage returns split records as in parsing
+    fasta_file.write_bytes(b"  >e\nMM\r>f\rKK\n\t>g\nWW")
+    assert list(FastaIndex(fasta_file)) == list(Fasta.read(fasta_file))
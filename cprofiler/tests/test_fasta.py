@@ -1,7 +1,10 @@
+import io
 import os
 
+import numpy as np
+
 from cprofiler.aminoacid import AminoAcid
-from cprofiler.fasta import Fasta
+from cprofiler.fasta import Fasta, Sequence, SequenceStore
 from cprofiler.profile import CompositionProfiler
 
 
@@ -19,3 +22,230 @@ def test_fasta_read_count():
 
     assert t[0, 0] == 7
     assert sum(t)[0] == 6623
+
+
+def test_count_chars_unknown_symbols():
+    """Test that Sequence.count_chars() and Fasta.count_chars() skip unknown symbols"""
+
+    sequences = [Sequence('a', 'ACDXXA*'), Sequence('b', ''), Sequence('c', 'yYB-C')]
+
+    assert list(sequences[0].count_chars('ACY')) == [2, 1, 0]
+
+    t = Fasta.count_chars(sequences, 'ACY')
+
+    assert t.shape == (3, 3)
+    assert list(t[1]) == [0, 0, 0]
+    assert list(t[2]) == [0, 1, 1]
+
+
+def test_iter_stream_count_stream():
+    """Test Fasta.iter_stream() and Fasta.count_stream() on multi-line records"""
+
+    text = "ignored\n>first seq \nAC\n\nDA\n>second\n>third\nCC\r\nA\n"
+
+    sequences = list(Fasta.iter_stream(io.StringIO(text)))
+
+    assert [seq.header for seq in sequences] == ['first seq', 'second', 'third']
+    assert [seq.sequence for seq in sequences] == ['ACDA', '', 'CCA']
+
+    t = Fasta.count_stream(io.StringIO(text), 'ACD', batch_size=2)
+
+    assert (t == Fasta.count_chars(sequences, 'ACD')).all()
+    assert list(t[0]) == [2, 1, 1]
+
+
+def test_permute_columns():
+    """Test Fasta.permute_columns() against counting directly in the target order"""
+
+    sequences = Fasta.read(CompositionProfiler.get_background_file('surface'))
+    t = Fasta.count_chars(sequences, AminoAcid.AA_1_LETTER)
+
+    assert Fasta.permute_columns(t, AminoAcid.AA_1_LETTER, AminoAcid.AA_1_LETTER) is t
+
+    reverse = Fasta.permute_columns(t, AminoAcid.AA_1_LETTER, AminoAcid.AA_1_LETTER[::-1])
+    assert reverse.base is t
+    assert (reverse == Fasta.count_chars(sequences, AminoAcid.AA_1_LETTER[::-1])).all()
+
+    for order in AminoAcid.list_orders():
+        alphabet = AminoAcid.get_order(order)
+        assert (Fasta.permute_columns(t, AminoAcid.AA_1_LETTER, alphabet) ==
+                Fasta.count_chars(sequences, alphabet)).all()
+
+
+def test_window_counts():
+    """Test sliding window counts and averages against counting every window"""
+
+    seq = Sequence('x', 'MKVLAXAKEEDRW')
+    alphabet = AminoAcid.AA_1_LETTER
+
+    counts = seq.window_counts(alphabet, 4)
+    expected = Fasta.count_chars([Sequence('', seq.sequence[i:i + 4])
+                                  for i in range(len(seq.sequence) - 3)], alphabet)
+
+    assert (counts == expected).all()
+    assert seq.window_counts(alphabet, 20).shape == (0, 20)
+
+    weights = Fasta.window_weights(alphabet, ['charged'], ['hydrophobicity_kyte'])
+    [(result, averages)] = list(Fasta.iter_windows([seq], alphabet, 4, weights))
+
+    assert result is seq
+    assert averages[0, 0] == 0.25
+    assert np.isclose(averages[0, 1], np.mean([AminoAcid.get_property('hydrophobicity_kyte', ch)
+                                               for ch in 'MKVL']))
+    assert np.allclose(averages[4], [1 / 3, np.mean([AminoAcid.get_property('hydrophobicity_kyte', ch)
+                                                     for ch in 'AAK'])])
+
+
+def test_count_kmers():
+    """Test k-mer counts against counting every k-mer one by one"""
+
+    sequences = [Sequence('a', 'MKVLAKXAKEEDRW'), Sequence('b', ''), Sequence('c', 'AKA')]
+
+    for alphabet, k in [(AminoAcid.AA_1_LETTER, 2), (AminoAcid.get_reduced_alphabet('murphy_4'), 3)]:
+        names = Fasta.kmer_names(alphabet, k)
+        counts = Fasta.count_kmers(sequences, alphabet, k)
+
+        assert counts.shape == (3, len(alphabet) ** k)
+        assert counts.dtype == np.uint32
+
+        symbol = {ch: name for name in alphabet for ch in name}
+        for seq, row in zip(sequences, counts):
+            expected = np.zeros(len(names))
+            for i in range(len(seq.sequence) - k + 1):
+                kmer = seq.sequence[i:i + k]
+                if all(ch in symbol for ch in kmer):
+                    name = ''.join(symbol[ch] if len(symbol[ch]) == 1 else f'[{symbol[ch]}]' for ch in kmer)
+                    expected[names.index(name)] += 1
+
+            assert (row == expected).all()
+
+    # Non-ASCII symbols are unknown and break k-mers, whether sequences are listed or stored
+    sequences = [Sequence('a', 'MQ\u00e9L'), Sequence('b', 'QL\u00e9\u00e9QL')]
+    counts = Fasta.count_kmers(sequences, AminoAcid.AA_1_LETTER, 2)
+
+    assert (counts == Fasta.count_kmers(SequenceStore.from_sequences(sequences), AminoAcid.AA_1_LETTER, 2)).all()
+    assert list(counts[:, Fasta.kmer_names(AminoAcid.AA_1_LETTER, 2).index('QL')]) == [0, 2]
+
+
+def test_sequence_store(tmp_path):
+    """Test that a SequenceStore behaves like the list of Sequences it holds"""
+
+    sequences = [Sequence('a b', 'ACDA' * 30), Sequence('empty', ''), Sequence('c', 'yYB-C')]
+    store = SequenceStore.from_sequences(sequences)
+
+    assert len(store) == 3
+    assert list(store) == sequences
+    assert store[-1] == sequences[-1] and store[0].header == 'a b'
+    assert list(store[1:]) == sequences[1:] and len(store[2:1]) == 0
+
+    alphabet = AminoAcid.AA_1_LETTER
+    assert (Fasta.count_chars(store, alphabet) == Fasta.count_chars(sequences, alphabet)).all()
+    assert (Fasta.count_chars(store[1:], alphabet) == Fasta.count_chars(sequences[1:], alphabet)).all()
+    assert (store[2].count_chars(alphabet) == sequences[2].count_chars(alphabet)).all()
+    assert (Fasta.count_kmers(store[0:2], alphabet, 2) == Fasta.count_kmers(sequences[0:2], alphabet, 2)).all()
+
+    Fasta.write(store, tmp_path / 'store.fa')
+    Fasta.write(sequences, tmp_path / 'list.fa')
+    assert (tmp_path / 'store.fa').read_bytes() == (tmp_path / 'list.fa').read_bytes()
+
+    assert list(Fasta.read(tmp_path / 'store.fa')) == sequences
+
+
+def test_count_dtype():
+    """Test that counts are stored in the narrowest unsigned type fitting the longest sequence"""
+
+    alphabet = AminoAcid.AA_1_LETTER
+
+    short = Fasta.count_chars([Sequence('a', 'A' * 65535)], alphabet)
+    assert short.dtype == np.uint16 and short[0, 0] == 65535
+
+    long = Fasta.count_chars([Sequence('a', 'C'), Sequence('b', 'A' * 65536)], alphabet)
+    assert long.dtype == np.uint32 and long[1, 0] == 65536 and long[0, 1] == 1
+
+
+def test_count_buffer_batches():
+    """Test that counting a buffer in pieces, which split records, gives the counts of one pass"""
+
+    store = SequenceStore.from_sequences([Sequence('a', 'ACDAXY' * 50), Sequence('b', ''),
+                                          Sequence('c', 'WW'), Sequence('d', 'KLMN' * 30)])
+    expected = Fasta.count_buffer(store.buffer, store.offsets, AminoAcid.AA_1_LETTER, 1 << 20)
+
+    assert expected[0, 0] == 100 and expected[3, 8] == 30
+    for batch_bytes in (1, 7, 64):
+        assert (Fasta.count_buffer(store.buffer, store.offsets, AminoAcid.AA_1_LETTER, batch_bytes) ==
+                expected).all()
+
+
+def test_count_parallel(tmp_path):
+    """Test that counting byte ranges in parallel matches counting the parsed file"""
+
+    fasta_file = tmp_path / 'sample.fa'
+    fasta_file.write_bytes(b"junk\n>a >b\nACDA\r\nWY\n\n>empty\n>c\nyyCC\nK>\n>d\nMMMM")
+
+    alphabet = AminoAcid.AA_1_LETTER
+    expected = Fasta.count_file(fasta_file, alphabet)
+
+    for chunk_bytes in (1, 7, 1 << 20):
+        assert (Fasta.count_parallel(fasta_file, alphabet, 2, chunk_bytes) == expected).all()
+
+    surface = CompositionProfiler.get_background_file('surface')
+    assert (Fasta.count_file(surface, alphabet, workers=3) == Fasta.count_file(surface, alphabet)).all()
+
+    (tmp_path / 'empty.fa').write_bytes(b'')
+    assert Fasta.count_file(tmp_path / 'empty.fa', alphabet, workers=2).shape == (0, 20)
+
+    # Irregular headers and line breaks give the records the stream parser reads
+    fasta_file.write_bytes(b"\n  >h1\nAC\n>h2 >x\r\nDE\rFG\r>h3\rHI\n\t>h4\nKL  >M\n \x0c>h5")
+    expected = Fasta.count_file(fasta_file, alphabet)
+    assert len(expected) == 5
+
+    for chunk_bytes in (1, 3, 1 << 20):
+        assert (Fasta.count_parallel(fasta_file, alphabet, 2, chunk_bytes) == expected).all()
+    assert (Fasta.count_file(fasta_file, alphabet, workers=4) == expected).all()
+
+
+def test_read_compressed(tmp_path):
+    """Test that compressed FastA files are recognized by their leading bytes and decompressed"""
+
+    import bz2
+    import gzip
+    import lzma
+
+    text = b">a\nACDA\nWY\n\n>b\nyyCC\n"
+    alphabet = AminoAcid.AA_1_LETTER
+    (tmp_path / 'plain.fa').write_bytes(text)
+    expected = Fasta.read(tmp_path / 'plain.fa')
+
+    for name, compress in (('gzip', gzip.compress), ('bz2', bz2.compress), ('xz', lzma.compress)):
+        # The extension does not matter, only the contents
+        fasta_file = tmp_path / f'sample.{name}'
+        fasta_file.write_bytes(compress(text))
+
+        assert Fasta.is_compressed(fasta_file)
+        assert list(Fasta.read(fasta_file)) == list(expected)
+        assert (Fasta.count_file(fasta_file, alphabet, workers=2) == Fasta.count_chars(expected, alphabet)).all()
+        assert Fasta.decompress_stream(io.BytesIO(compress(text))).read() == text
+
+    assert not Fasta.is_compressed(tmp_path / 'plain.fa')
+    assert Fasta.decompress_stream(io.BytesIO(text)).read() == text
+
+
+def test_write(tmp_path):
+    """Test that records are written in batches, from generators and compressed, in the same format"""
+
+    import gzip
+
+    sequences = [Sequence('a', 'A' * 80), Sequence('', ''), Sequence('c é', 'C' * 161)]
+    expected = ">a\n" + "A" * 80 + "\n\n>\n\n>c é\n" + ("C" * 80 + "\n") * 2 + "C\n\n"
+
+    Fasta.write(sequences, tmp_path / 'list.fa')
+    assert (tmp_path / 'list.fa').read_text(encoding='utf-8') == expected
+
+    Fasta.write(SequenceStore.from_sequences(sequences), tmp_path / 'store.fa', batch_bytes=1)
+    assert (tmp_path / 'store.fa').read_text(encoding='utf-8') == expected
+
+    Fasta.write(Fasta.iter(tmp_path / 'list.fa'), tmp_path / 'copy.fa.gz')
+    assert gzip.decompress((tmp_path / 'copy.fa.gz').read_bytes()).decode('utf-8') == expected
+
+    Fasta.write(sequences[0:1], tmp_path / 'narrow.fa', width=60)
+    assert (tmp_path / 'narrow.fa').read_text() == ">a\n" + "A" * 60 + "\n" + "A" * 20 + "\n\n"
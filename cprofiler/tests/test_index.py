@@ -0,0 +1,31 @@
+import numpy as np
+
+from cprofiler.index import CompositionIndex
+
+
+def test_index_search(tmp_path):
+    """Test that CompositionIndex.search() matches an exhaustive search"""
+
+    fasta_file = tmp_path / 'sample.fa'
+    fasta_file.write_text(">a\nAAAC\n>b\nCCCD\n>c\nACDE\n>d\nAAAA\n>e\n\n>f\nDEDE\n")
+
+    index = CompositionIndex.build(fasta_file, tmp_path / 'index', alphabet='ACDE', batch_size=4)
+
+    assert len(index) == 6
+    assert [index.get_header(i) for i in range(6)] == ['a', 'b', 'c', 'd', 'e', 'f']
+    assert np.allclose(index.frequencies[0], [0.75, 0.25, 0, 0])
+
+    query_counts = np.array([[3, 1, 0, 0], [0, 0, 1, 1]])
+    queries = CompositionIndex.normalize(query_counts)
+
+    for metric in CompositionIndex.METRICS:
+        indices, distances = index.search(query_counts, k=3, metric=metric, block_size=4, workers=2)
+        expected = CompositionIndex.distances(np.asarray(index.frequencies), queries, metric)
+
+        assert indices.shape == (2, 3)
+        assert np.allclose(distances, np.sort(expected, axis=1)[:, 0:3])
+        assert np.allclose(np.take_along_axis(expected, indices, axis=1), distances)
+
+    indices, distances = index.search(query_counts, k=1, metric='l1')
+    assert list(indices[:, 0]) == [0, 5]
+    assert np.allclose(distances[:, 0], 0)
@@ -0,0 +1,32 @@
+import sys
+
+from cprofiler.main import main
+from cprofiler.profile import CompositionProfiler
+
+
+def test_score(tmp_path, monkeypatch, capsys):
+    """Test that the score command runs end to end with its default options"""
+
+    monkeypatch.setenv('CPROFILER_CACHE_DIR', str(tmp_path / 'cache'))
+
+    query_file = tmp_path / 'query.fa'
+    query_file.write_text(">q1\nPPPPEEEKKS\n>q2\nPEPEKSKSPE\n")
+
+    score_file = tmp_path / 'score.fa'
+    score_file.write_text(">s1\nPPEEKK\n>s2\nLLIIVVFF\n")
+
+    monkeypatch.setattr(sys, 'argv', ['cprof', 'score', '-Q', str(query_file), '-S', str(score_file),
+                                      '-D', 'sprot'])
+    main()
+
+    output = capsys.readouterr().out
+    lines = [line.split('\t') for line in output.splitlines()]
+    assert [line[0:2] for line in lines] == [['s1', '6'], ['s2', '8']]
+    assert float(lines[0][2]) > float(lines[1][2])
+
+    # The preset background file counted with threads gives the same scores
+    monkeypatch.setattr(sys, 'argv', ['cprof', 'score', '-Q', str(query_file), '-S', str(score_file),
+                                      '-B', str(CompositionProfiler.get_background_file('sprot')),
+                                      '-j', '2'])
+    main()
+    assert capsys.readouterr().out == output
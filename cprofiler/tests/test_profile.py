@@ -1,3 +1,7 @@
+import io
+
+import numpy as np
+
 from cprofiler.aminoacid import AminoAcid
 from cprofiler.fasta import Fasta
 from cprofiler.profile import CompositionProfiler
@@ -47,3 +51,305 @@ def test_relent():
 
     assert abs(relent - 0.059797352551317795) < 1e-6
     assert pvalue <= 0.0001
+
+
+def test_permuted_sums():
+    """Test that every permutation selects exactly query_len distinct rows"""
+
+    combined_counts = np.eye(50)
+
+    for query_len in [3, 20, 45]:
+        blocks = list(CompositionProfiler.permuted_sums(combined_counts, query_len, 500,
+                                                        memory=8 * 50 * 64))
+        sums = np.concatenate(blocks, axis=0)
+
+        assert len(blocks) > 1
+        assert sums.shape == (500, 50)
+        assert set(np.unique(sums)) <= {0, 1}
+        assert (np.sum(sums, axis=1) == query_len).all()
+
+        # Every row is drawn into the query with probability query_len / 50
+        assert (abs(np.mean(sums, axis=0) - query_len / 50) < 0.1).all()
+
+
+def test_relative_entropy_block():
+    """Test that CompositionProfiler.relative_entropy() treats each row of a block independently"""
+
+    query_sums = np.array([[1.0, 2.0, 3.0], [3.0, 3.0, 3.0], [0.0, 1.0, 1.0]])
+    back_sum = np.array([2.0, 2.0, 2.0])
+
+    r = CompositionProfiler.relative_entropy(query_sums, back_sum)
+
+    for i in range(2):
+        assert abs(r[i] - CompositionProfiler.relative_entropy(query_sums[i], back_sum)) < 1e-12
+
+    assert abs(r[1]) < 1e-12
+    assert np.isnan(r[2])
+
+
+def test_bootstrap_sums():
+    """Test that every bootstrap resample draws N rows with replacement"""
+
+    counts = np.column_stack((np.ones(40), np.arange(40)))
+
+    sums = np.concatenate(list(CompositionProfiler.bootstrap_sums(counts, 300, memory=24 * 40 * 50)))
+
+    assert sums.shape == (300, 2)
+    assert (sums[:, 0] == 40).all()
+
+    # Resampled mean of 0..39 is centered on 19.5, with standard deviation 11.5 / sqrt(40)
+    assert abs(np.mean(sums[:, 1] / 40) - 19.5) < 0.5
+    assert abs(np.std(sums[:, 1] / 40) - 11.54 / np.sqrt(40)) < 0.4
+
+
+def test_reproducible_workers():
+    """Test that results depend on the seed, but not on the number of workers"""
+
+    query_counts = CompositionProfiler.get_background_counts('surface')[:40]
+    background_counts = CompositionProfiler.get_background_counts('pdbs25')[:400]
+
+    alphabet = AminoAcid.AA_1_LETTER
+
+    pvalues = [CompositionProfiler.discover(query_counts, background_counts, alphabet,
+                   groups = AminoAcid.AA_GROUP,
+                   group_names = AminoAcid.AA_GROUP_NAME,
+                   iterations = 2000,
+                   workers = workers,
+                   seed = seed).pvalue
+               for workers, seed in [(1, 7), (2, 7), (1, 8)]]
+
+    assert (pvalues[0] == pvalues[1]).all()
+    assert (pvalues[0] != pvalues[2]).any()
+
+    assert CompositionProfiler.relent(query_counts, background_counts, 2000, workers=1) == \
+        CompositionProfiler.relent(query_counts, background_counts, 2000, workers=3)
+
+
+def test_discover_adaptive():
+    """Test that adaptive sampling reaches the decisions of the full run with fewer permutations"""
+
+    query_counts = CompositionProfiler.get_background_counts('surface')
+    background_counts = CompositionProfiler.get_background_counts('pdbs25')
+
+    alphabet = AminoAcid.AA_1_LETTER
+
+    kwargs = dict(groups = AminoAcid.AA_GROUP,
+                  group_names = AminoAcid.AA_GROUP_NAME,
+                  iterations = 10000,
+                  alpha_value = 0.05 / 40)
+
+    df = CompositionProfiler.discover(query_counts, background_counts, alphabet, **kwargs)
+    adaptive = CompositionProfiler.discover(query_counts, background_counts, alphabet,
+                                            adaptive=True, **kwargs)
+
+    assert (df.test_result == adaptive.test_result).all()
+    assert (adaptive.iterations <= 10000).all()
+    assert adaptive.iterations[5] < 1000
+
+
+def test_analytic():
+    """Test that analytic approximations agree with permutation and bootstrap sampling"""
+
+    query_counts = CompositionProfiler.get_background_counts('surface')
+    background_counts = CompositionProfiler.get_background_counts('pdbs25')
+
+    alphabet = AminoAcid.AA_1_LETTER
+
+    kwargs = dict(groups = AminoAcid.AA_GROUP,
+                  group_names = AminoAcid.AA_GROUP_NAME,
+                  iterations = 10000,
+                  alpha_value = 0.05)
+
+    df = CompositionProfiler.discover(query_counts, background_counts, alphabet, **kwargs)
+    analytic = CompositionProfiler.discover(query_counts, background_counts, alphabet,
+                                            method='analytic', **kwargs)
+
+    assert (df.test_result == analytic.test_result).all()
+    assert (abs(df.pvalue - analytic.pvalue) < 0.02).all()
+
+    relent, pvalue = CompositionProfiler.relent(query_counts, background_counts, method='analytic')
+    assert pvalue <= 0.0001
+
+    assert abs(CompositionProfiler.chi2_sf(3.841459, 1) - 0.05) < 1e-6
+    assert abs(CompositionProfiler.chi2_sf(30.143527, 19) - 0.05) < 1e-6
+
+
+def test_analyze():
+    """Test that analyze matches separate discover, relent and plot runs"""
+
+    query_counts = CompositionProfiler.get_background_counts('surface')[0:200]
+    background_counts = CompositionProfiler.get_background_counts('pdbs25')
+
+    alphabet = AminoAcid.AA_1_LETTER
+
+    df, relent, pvalue, errors = CompositionProfiler.analyze(query_counts,
+        background_counts, alphabet, AminoAcid.AA_GROUP, AminoAcid.AA_GROUP_NAME,
+        iterations=2000)
+
+    expected = CompositionProfiler.discover(query_counts, background_counts, alphabet,
+        AminoAcid.AA_GROUP, AminoAcid.AA_GROUP_NAME, iterations=2000)
+
+    assert (df.pvalue == expected.pvalue).all()
+    assert (df.test_result == expected.test_result).all()
+    assert (relent, pvalue) == CompositionProfiler.relent(query_counts, background_counts, 2000)
+    assert np.array_equal(errors, CompositionProfiler.bootstrap_errors(query_counts,
+        background_counts, alphabet, 2000))
+
+
+def test_discover_many():
+    """Test that discover_many matches discover on each query"""
+
+    surface = CompositionProfiler.get_background_counts('surface')
+    background_counts = CompositionProfiler.get_background_counts('pdbs25')
+
+    query_counts = [surface[0:30], surface[30:60], surface[60:100], surface[100:105]]
+
+    kwargs = dict(alphabet = AminoAcid.AA_1_LETTER,
+                  groups = AminoAcid.AA_GROUP,
+                  group_names = AminoAcid.AA_GROUP_NAME,
+                  iterations = 1000)
+
+    df = CompositionProfiler.discover_many(query_counts, background_counts,
+                                           query_names=['a', 'b', 'c', 'd'], **kwargs)
+
+    assert list(df['query'].unique()) == ['a', 'b', 'c', 'd']
+
+    for name, counts in zip('abcd', query_counts):
+        expected = CompositionProfiler.discover(counts, background_counts, **kwargs)
+        result = df[df['query'] == name]
+
+        assert np.array_equal(result.pvalue.values, expected.pvalue.values)
+        assert (result.test_result.values == expected.test_result.values).all()
+
+
+def test_relent_matrix():
+    """Test the relative entropy matrix against pairwise relative entropies"""
+
+    counts = [CompositionProfiler.get_background_counts(name) for name in ['surface', 'pdbs25', 'disprot']]
+
+    relent, pvalues = CompositionProfiler.relent_matrix(counts, iterations=200)
+
+    for i in range(len(counts)):
+        for j in range(len(counts)):
+            query_sum = np.sum(counts[i], axis=0)
+            back_sum = np.sum(counts[j], axis=0)
+
+            expected = (CompositionProfiler.relative_entropy(query_sum, back_sum) +
+                        CompositionProfiler.relative_entropy(back_sum, query_sum)) / 2
+            assert abs(relent[i, j] - expected) < 1e-12
+
+    assert (np.diag(pvalues) == 1).all()
+    assert (pvalues == pvalues.T).all()
+    assert pvalues[0, 2] == 0
+
+
+def test_score_stream():
+    """Test log-odds scores of streamed sequences"""
+
+    query_counts = np.array([[3, 1, 0], [2, 0, 0]])
+    background_counts = np.array([[1, 1, 1], [0, 2, 1]])
+
+    weights = CompositionProfiler.get_weights(query_counts, background_counts)
+    assert np.allclose(weights, np.log([(6 / 9) / (2 / 9), (2 / 9) / (4 / 9), (1 / 9) / (3 / 9)]))
+
+    fin = io.StringIO(">a\nAAC\n>b\nGXA\nG\n")
+    batches = list(CompositionProfiler.score_stream(fin, weights, 'ACG', batch_size=1))
+
+    assert [batch[0] for batch in batches] == [['a'], ['b']]
+    assert [batch[1][0] for batch in batches] == [3, 4]
+    assert np.allclose(np.concatenate([batch[2] for batch in batches]),
+                       [2 * weights[0] + weights[1], weights[0] + 2 * weights[2]])
+
+
+def test_adjust_pvalues():
+    """Test Benjamini-Hochberg q-values"""
+
+    pvalues = np.array([0.01, 0.04, 0.03, np.nan, 0.2])
+    qvalues = CompositionProfiler.adjust_pvalues(pvalues)
+
+    assert np.allclose(qvalues[[0, 1, 2, 4]], [0.04, 0.04 * 4 / 3, 0.04 * 4 / 3, 0.2])
+    assert np.isnan(qvalues[3])
+
+    df = CompositionProfiler.format_results(list('abcde'), np.ones(5), pvalues, 0.05, fdr=True)
+    assert list(df.test_result) == ['Enriched', 'Not significant', 'Not significant',
+                                    'Not significant', 'Not significant']
+
+
+def test_get_expansion():
+    """Test that group columns computed from residue sums match summed group members"""
+
+    alphabet = AminoAcid.AA_1_LETTER
+    rng = np.random.default_rng(0)
+    counts = rng.integers(0, 100, size=(6, len(alphabet))).astype(np.uint16)
+
+    expansion = CompositionProfiler.get_expansion(alphabet, AminoAcid.AA_GROUP)
+    sums = CompositionProfiler.expand_sums(np.sum(counts, axis=0, dtype=np.int64), expansion)
+
+    assert (sums[0:len(alphabet)] == np.sum(counts, axis=0)).all()
+    for i, members in enumerate(AminoAcid.AA_GROUP.values()):
+        cols = [alphabet.index(x) for x in members]
+        assert sums[len(alphabet) + i] == np.sum(counts[:, cols])
+
+    assert CompositionProfiler.get_expansion(alphabet, {}) is None
+    assert CompositionProfiler.get_exact_dtype(counts) == np.float32
+
+
+def test_deduplicate():
+    """Test that unique rows with multiplicities are sampled like the rows they stand for"""
+
+    rng = np.random.default_rng(1)
+    base = rng.integers(0, 50, size=(4, 3))
+    counts = base[rng.integers(0, 4, 200)]
+
+    unique_counts, weights = CompositionProfiler.deduplicate(counts)
+    assert len(unique_counts) == 4 and np.sum(weights) == 200
+    assert (weights @ unique_counts == np.sum(counts, axis=0)).all()
+
+    # Permuted query sums keep the total query size and the expected sums
+    sums = np.concatenate(list(CompositionProfiler.permuted_sums(unique_counts, 30, 2000, seed=2,
+                                                                 weights=weights)))
+    assert np.allclose(np.mean(sums, axis=0), 30 / 200 * np.sum(counts, axis=0), rtol=0.02)
+    assert (sums <= np.sum(counts, axis=0)).all()
+
+    plain = np.concatenate(list(CompositionProfiler.bootstrap_sums(counts, 2000, seed=2)))
+    weighted = np.concatenate(list(CompositionProfiler.bootstrap_sums(unique_counts, 2000, seed=2,
+                                                                      weights=weights)))
+    assert np.allclose(np.std(weighted, axis=0), np.std(plain, axis=0), rtol=0.1)
+
+    # Same effects, and the same calls where differences are clear
+    query_counts = counts[0:40] + np.array([5, 0, 0])
+    df = CompositionProfiler.discover(query_counts, counts, 'ABC', {}, {}, iterations=2000)
+    deduplicated = CompositionProfiler.discover(query_counts, counts, 'ABC', {}, {}, iterations=2000,
+                                                dedup=True)
+
+    assert np.allclose(df.effect, deduplicated.effect)
+    assert (df.test_result == deduplicated.test_result).all()
+
+
+def test_relent_matrix_workers():
+    """Test that relent_matrix p-values do not depend on the number of workers when
+    the pairs of sets differ in size"""
+
+    counts = CompositionProfiler.get_background_counts('sprot')
+    counts = counts[np.random.default_rng(0).permutation(len(counts))]
+    counts = [counts[0:2600], counts[2600:4600], counts[4600:]]
+
+    _, pvalues = CompositionProfiler.relent_matrix(counts, 1000, workers=1)
+    assert (pvalues == CompositionProfiler.relent_matrix(counts, 1000, workers=3)[1]).all()
+
+
+def test_permutation_variance():
+    """Test that diagonal variances match the expanded full permutation covariance"""
+
+    alphabet = AminoAcid.AA_1_LETTER
+    rng = np.random.default_rng(0)
+    query_counts = rng.integers(0, 50, size=(30, len(alphabet))).astype(np.uint16)
+    background_counts = rng.integers(0, 50, size=(70, len(alphabet))).astype(np.uint16)
+
+    expansion = CompositionProfiler.get_expansion(alphabet, AminoAcid.AA_GROUP)
+    freq, cov = CompositionProfiler.permutation_covariance(query_counts, background_counts, len(alphabet))
+    diag_freq, variances = CompositionProfiler.permutation_variance(query_counts, background_counts,
+                                                                    len(alphabet), expansion)
+
+    assert np.allclose(diag_freq, freq @ expansion)
+    assert np.allclose(variances, np.diag(expansion.T @ cov @ expansion))